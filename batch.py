@@ -0,0 +1,240 @@
+import os
+import sys
+from concurrent.futures import Future, ProcessPoolExecutor
+from os.path import realpath
+from queue import Empty, Queue
+from threading import Thread
+from typing import List, Tuple
+
+from converter import (clone_file, convert_file, format_costs, load_file,
+                       reset_camera, Translation)
+from manifest import Manifest, data_hash
+from reduction import format_reductions
+from structure.version import GAME, GMTProperties
+from util.read_gmd import set_gmd_cache_dir
+
+
+class Job:
+    def __init__(self, path: str, outputs: List[Tuple[str, str]], is_camera=False):
+        self.path = path
+        self.outputs = outputs
+        self.is_camera = is_camera
+        self.source = None
+
+    path: str
+    outputs: List[Tuple[str, str]]  # (target game, output path)
+    is_camera: bool  # cmt files are only reset, not converted
+    source: tuple  # (size, mtime, hash) of the input as it was read, for the manifest
+
+
+# marks the end of a stage's queue
+DONE = None
+
+
+def error_message(e: Exception) -> str:
+    return f"{type(e).__name__}: {e}"
+
+
+# returns ([(converted file, error) for every output], stage costs, write stats) instead of raising,
+# so one bad file or target does not stop the batch
+def convert_job(job: Job, data: bytes, args, translation: Translation):
+    costs = {} if args.explain else None
+    stats = {} if args.dedup or args.reduce is not None else None
+    try:
+        if job.is_camera:
+            # cameras do not depend on the target game
+            is_de = GMTProperties(GAME[args.ingame]).is_dragon_engine
+            out = reset_camera(job.path, translation.offset,
+                               translation.add_offset, is_de, data=data)
+            return ([(out, None)] * len(job.outputs), costs, None)
+        in_file = load_file(job.path, data, costs)
+    except Exception as e:
+        return ([(None, error_message(e))] * len(job.outputs), None, None)
+
+    # the file is parsed once, every target but the last converts a clone of it
+    results = []
+    for i, (game, _) in enumerate(job.outputs):
+        try:
+            gmt = clone_file(in_file, costs) if i < len(
+                job.outputs) - 1 else in_file
+            out = convert_file(gmt, args.ingame, game, args.motion, translation,
+                               costs=costs, dedup=args.dedup, stats=stats, tolerance=args.reduce)
+            results.append((out, None))
+        except Exception as e:
+            results.append((None, error_message(e)))
+    return (results, costs, stats)
+
+
+def read_stage(jobs: List[Job], read_queue: Queue, manifest: Manifest):
+    # prefetches input files while earlier ones are being converted
+    # DONE is always queued, so the later stages never wait on a dead reader
+    try:
+        for job in jobs:
+            try:
+                with open(realpath(job.path), "rb") as f:
+                    stat = os.fstat(f.fileno())
+                    data = f.read()
+                if manifest:
+                    job.source = (stat.st_size, stat.st_mtime_ns, data_hash(data))
+            except Exception as e:
+                data = e
+            read_queue.put((job, data))
+    finally:
+        read_queue.put(DONE)
+
+
+def convert_stage(read_queue: Queue, write_queue: Queue, pool: ProcessPoolExecutor, args, translation: Translation):
+    # with a pool, futures are queued so the writer waits on them in order
+    # a job that cannot be submitted (a broken pool) fails on its own,
+    # and DONE is always queued, so the writer never waits on a dead stage
+    try:
+        while True:
+            item = read_queue.get()
+            if item is DONE:
+                break
+            job, data = item
+            if isinstance(data, Exception):
+                result = ([(None, error_message(data))] * len(job.outputs), None, None)
+            elif pool:
+                try:
+                    result = pool.submit(convert_job, job, data, args, translation)
+                except Exception as e:
+                    result = ([(None, error_message(e))] * len(job.outputs), None, None)
+            else:
+                result = convert_job(job, data, args, translation)
+            write_queue.put((job, result))
+    finally:
+        write_queue.put(DONE)
+
+
+def write_output(job: Job, game: str, output: str, out: bytes, manifest: Manifest) -> str:
+    # outputs come back from the workers as bytes, so batch mode holds each one in memory
+    # until it is written, the queue depths bound how many at once
+    try:
+        with open(realpath(output), "wb") as f:
+            f.write(out)
+        if manifest:
+            manifest.record(job.path, output, game, job.source, out)
+    except OSError as e:
+        return error_message(e)
+
+
+def write_results(job: Job, result, manifest: Manifest, costs, stats) -> List[str]:
+    # returns the error of every output, None for the ones that were written
+    if isinstance(result, Future):
+        try:
+            result = result.result()
+        except Exception as e:
+            return [error_message(e)] * len(job.outputs)
+
+    outs, job_costs, job_stats = result
+    for stage, cost in (job_costs or {}).items():
+        costs[stage] = costs.get(stage, 0.0) + cost
+    for key, value in (job_stats or {}).items():
+        # byte counts are summed, per curve results are concatenated
+        stats[key] = stats[key] + value if key in stats else value
+
+    errors = []
+    for (game, output), (out, error) in zip(job.outputs, outs):
+        if not error:
+            error = write_output(job, game, output, out, manifest)
+        errors.append(error)
+    return errors
+
+
+def input_size(job: Job) -> int:
+    # missing files are scheduled last, and fail when they are read
+    try:
+        return os.path.getsize(realpath(job.path))
+    except OSError:
+        return -1
+
+
+def stop_pool(pool: ProcessPoolExecutor, write_queue: Queue):
+    # queued futures are cancelled by hand too, since cancel_futures needs Python 3.9
+    while True:
+        try:
+            item = write_queue.get_nowait()
+        except Empty:
+            break
+        if item is not DONE and isinstance(item[1], Future):
+            item[1].cancel()
+    if sys.version_info >= (3, 9):
+        pool.shutdown(cancel_futures=True)
+    else:
+        pool.shutdown()
+
+
+# files are read, converted and written by separate stages connected by bounded queues,
+# so at most read_depth inputs and write_depth + workers outputs are held in memory
+def run_batch(jobs: List[Job], args, translation: Translation, workers=1, read_depth=2, write_depth=2, manifest: Manifest = None) -> int:
+    pool = None
+    if workers > 1 and len(jobs) > 1:
+        # each worker keeps its own skeleton cache, backed by the same folder
+        pool = ProcessPoolExecutor(
+            workers, initializer=set_gmd_cache_dir, initargs=(args.gmdcache,))
+        # largest files are scheduled first, so no worker is left with a big file at the end
+        # the sort is stable, so files of the same size keep their walk order
+        jobs = sorted(jobs, key=input_size, reverse=True)
+
+    read_queue = Queue(max(read_depth, 1))
+    write_queue = Queue(max(write_depth, 1) + (workers if pool else 0))
+
+    stages = [
+        Thread(target=read_stage, args=(jobs, read_queue, manifest), daemon=True),
+        Thread(target=convert_stage, args=(read_queue, write_queue,
+               pool, args, translation), daemon=True),
+    ]
+    for t in stages:
+        t.start()
+
+    # the writer runs on the calling thread and reports in the order jobs are scheduled
+    # the manifest is saved as it goes and once more however the batch ends,
+    # so outputs already written are not converted again after an interruption
+    # if the writer fails, the pool is stopped with every queued file cancelled
+    failed = 0
+    costs = {}
+    stats = {}
+    finished = False
+    try:
+        while True:
+            item = write_queue.get()
+            if item is DONE:
+                break
+            job, result = item
+            errors = write_results(job, result, manifest, costs, stats)
+            for (_, output), error in zip(job.outputs, errors):
+                if error:
+                    failed += 1
+                    if manifest:
+                        manifest.discard(output)
+                    print(f"failed {output}: {error}")
+                else:
+                    print(f"converted {output}")
+            if manifest:
+                manifest.checkpoint()
+
+        for t in stages:
+            t.join()
+        finished = True
+    finally:
+        if manifest:
+            manifest.save()
+        if pool:
+            if finished:
+                pool.shutdown()
+            else:
+                stop_pool(pool, write_queue)
+
+    if failed:
+        print(f"{failed} of {sum(len(j.outputs) for j in jobs)} files failed")
+    if 'reductions' in stats:
+        for line in format_reductions(stats['reductions'], args.explain):
+            print(line)
+    if 'dedup saved' in stats:
+        print(f"deduplicated curve data saved {stats['dedup saved']} bytes")
+    if len(costs):
+        print("stage costs (summed over every file):")
+        for line in format_costs(costs):
+            print(f"    {line}")
+    return failed
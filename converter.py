@@ -1,11 +1,11 @@
 import math
-from copy import deepcopy
 from os.path import basename
-from typing import List
+from time import perf_counter
+from typing import Callable, Dict, List, Tuple
 
-from pyquaternion import Quaternion
-
-from read import read_file
+from read import read_file, read_gmt
+from reduction import reduce_file
+from retarget import apply_plan, retarget_plan
 from structure.animation import Animation
 from structure.bone import Bone, find_bone
 from structure.curve import *
@@ -13,16 +13,22 @@ from structure.file import GMTFile
 from structure.graph import *
 from structure.header import GMTHeader
 from structure.name import Name
-from structure.types.format import CurveFormat, curve_array_to_quat
+from structure.types.format import CurveFormat, curve_values_to_quats
 from structure.version import *
 from util.binary import BinaryReader
+from util import position, quaternion
 from util.dicts import *
-from util.read_cmt import read_cmt_file
+from util.read_cmt import parse_cmt_file, read_cmt_file
 from util.read_gmd import (GMDBone, find_gmd_bone, get_face_bones, read_gmd_bones)
 from util.write_cmt import write_cmt_file
 from write import write_file
 
 
+# bumped whenever a change to the conversion changes its output,
+# so outputs recorded by an older converter are not reused
+CONVERTER_VERSION = 1
+
+
 class Translation:
     def __init__(self, rp: bool, fc: bool, hn: bool, bd: bool, sgmd: str, tgmd: str, rst: bool, rhct: bool, aoff: str, sp: str):
         self.reparent = rp
@@ -51,131 +57,211 @@ class Translation:
     def has_speed(self):
         return self.speed != "1"
 
-# returns converted file as bytearray
+def compose_maps(maps: List[Dict]) -> Dict:
+    # a single map with the same result as applying every map in order
+    composite = {}
+    for key in set().union(*maps):
+        value = key
+        for m in maps:
+            value = m.get(value, value)
+        if value != key:
+            composite[key] = value
+    return composite
+
+
+def remap_formats(bones: List[Bone], format_map) -> List[Bone]:
+    for b in bones:
+        for c in b.curves:
+            if c.curve_format in format_map:
+                c.curve_format = format_map[c.curve_format]
+    return bones
 
 
-def convert(path, src_game, dst_game, motion, translation) -> bytearray:
-    in_file = read_file(path)
-    src_gmt = GMTProperties(GAME[src_game])
-    dst_gmt = GMTProperties(GAME[dst_game])
-
-    in_file.header.version = dst_gmt.version
-
-    if src_gmt.version != dst_gmt.version:
-        if src_gmt.version == GMTProperties('KENZAN').version:
-            # convert 0x2 format quaternions from float to scaled
-            for anm in in_file.animations:
-                for b in anm.bones:
-                    for c in b.curves:
-                        if c.curve_format in FLOAT_TO_SCALED:
-                            c.curve_format = FLOAT_TO_SCALED[c.curve_format]
-
-        if dst_gmt.version < GMTProperties('YAKUZA_5').version:
-            if src_gmt.version >= GMTProperties('YAKUZA_5').version:
-                # convert 0x1E format to 0x2
-                # not needed cause we'll always change it
-                for anm in in_file.animations:
-                    for b in anm.bones:
-                        for c in b.curves:
-                            if c.curve_format == CurveFormat.ROT_QUAT_INT_SCALED:
-                                c.curve_format = CurveFormat.ROT_QUAT_SCALED
-
-            if dst_gmt.version == GMTProperties('KENZAN').version:
-                # convert 0x2 format quaternions from scaled to float
-                for anm in in_file.animations:
-                    for b in anm.bones:
-                        for c in b.curves:
-                            if c.curve_format in SCALED_TO_FLOAT:
-                                c.curve_format = SCALED_TO_FLOAT[c.curve_format]
-
-    if src_gmt < dst_gmt:
-        if (not src_gmt.new_bones) and dst_gmt.new_bones:
-            # rename to new
-            for anm in in_file.animations:
-                for bone in anm.bones:
-                    bone.name.update(NEW_BONES.get(
-                        bone.name.string(), bone.name.string()))
-        if dst_gmt.is_dragon_engine:
-            # rename to de
-            for anm in in_file.animations:
-                for bone in anm.bones:
-                    bone.name.update(DE_BONES.get(
-                        bone.name.string(), bone.name.string()))
-        """
-        # add scale bone
-        for anm in in_file.animations:
-            if not len([b for b in anm.bones if b.name.string() == "scale"]):
-                anm.bones = add_scale_bone(anm.bones, anm.graphs)
-        """
-    else:
+def rename_bones(bones: List[Bone], name_map) -> List[Bone]:
+    for bone in bones:
+        name = name_map.get(bone.name.string())
+        if name:
+            bone.name.update(name)
+    return bones
+
+
+class ConversionPlan:
+    # every decision convert makes from the games, motion and translation,
+    # made once and reused for every file with the same options
+    # stages are run in order, each one over every animation in the file
+    def __init__(self, src_game, dst_game, motion, translation):
+        src_gmt = GMTProperties(GAME[src_game])
+        dst_gmt = GMTProperties(GAME[dst_game])
+
+        self.version = dst_gmt.version
+        self.stages = []
+
+        format_maps = []
+        if src_gmt.version != dst_gmt.version:
+            if src_gmt.version == GMTProperties('KENZAN').version:
+                # convert 0x2 format quaternions from float to scaled
+                format_maps.append(FLOAT_TO_SCALED)
+
+            if dst_gmt.version < GMTProperties('YAKUZA_5').version:
+                if src_gmt.version >= GMTProperties('YAKUZA_5').version:
+                    # convert 0x1E format to 0x2
+                    # not needed cause we'll always change it
+                    format_maps.append(
+                        {CurveFormat.ROT_QUAT_INT_SCALED: CurveFormat.ROT_QUAT_SCALED})
+
+                if dst_gmt.version == GMTProperties('KENZAN').version:
+                    # convert 0x2 format quaternions from scaled to float
+                    format_maps.append(SCALED_TO_FLOAT)
+        self.format_map = compose_maps(format_maps)
+
+        name_maps = []
+        if src_gmt < dst_gmt:
+            if (not src_gmt.new_bones) and dst_gmt.new_bones:
+                # rename to new
+                name_maps.append(NEW_BONES)
+            if dst_gmt.is_dragon_engine:
+                # rename to de
+                name_maps.append(DE_BONES)
+        else:
+            if src_gmt.is_dragon_engine:
+                name_maps.append(DE_OLD_BONES)
+            if (not dst_gmt.new_bones) and src_gmt.new_bones:
+                name_maps.append(OLD_BONES)
+        self.name_map = compose_maps(name_maps)
+
+        if len(self.format_map):
+            self.add_stage(f"remap {len(self.format_map)} curve formats",
+                           lambda bones: remap_formats(bones, self.format_map))
+        if len(self.name_map):
+            self.add_stage(f"rename bones ({len(self.name_map)} names)",
+                           lambda bones: rename_bones(bones, self.name_map))
+
+        if translation.reset:
+            self.add_stage("reset vector", lambda bones: reset_vector(
+                bones, src_gmt.new_bones, motion=motion))
+        elif translation.resethact:
+            self.add_stage("reset hact vector", lambda bones: reset_vector(bones, src_gmt.new_bones, is_de=src_gmt.is_dragon_engine,
+                                                                            offset=translation.offset, add_offset=translation.add_offset))
+
         if src_gmt.is_dragon_engine:
-            for anm in in_file.animations:
-                for bone in anm.bones:
-                    bone.name.update(DE_OLD_BONES.get(
-                        bone.name.string(), bone.name.string()))
-        if (not dst_gmt.new_bones) and src_gmt.new_bones:
-            for anm in in_file.animations:
-                for bone in anm.bones:
-                    bone.name.update(OLD_BONES.get(
-                        bone.name.string(), bone.name.string()))
-
-    if translation.reset:
-        for anm in in_file.animations:
-            anm.bones = reset_vector(
-                anm.bones, src_gmt.new_bones, motion=motion)
-    elif translation.resethact:
-        for anm in in_file.animations:
-            anm.bones = reset_vector(anm.bones, src_gmt.new_bones, is_de=src_gmt.is_dragon_engine,
-                                     offset=translation.offset, add_offset=translation.add_offset)
-
-    if src_gmt.is_dragon_engine:
-        if not dst_gmt.is_dragon_engine:
-            # convert values in kosi to be direct child of center
-            for anm in in_file.animations:
-                anm.bones = de_to_old_kosi(anm.bones)
-    elif dst_gmt.is_dragon_engine:
-        # convert values in kosi to be direct child of ketu
-        for anm in in_file.animations:
-            anm.bones = old_to_de_kosi(anm.bones)
-
-    if src_gmt.new_bones:
-        if not dst_gmt.new_bones or (src_gmt.is_dragon_engine and not dst_gmt.is_dragon_engine):
-            # convert new bones to old bones (remove _c_n and add vector (and sync) to center)
-            for anm in in_file.animations:
-                anm.bones = new_to_old_bones(
-                    anm.bones, src_gmt.is_dragon_engine, dst_gmt.new_bones, motion, translation.targetgmd)
-        elif not src_gmt.is_dragon_engine and dst_gmt.is_dragon_engine:
-            # convert post-Y5 bones to DE bones (copy center movement to vector)
-            for anm in in_file.animations:
-                anm.bones = old_to_new_bones(
-                    anm.bones, src_gmt.new_bones, dst_gmt.is_dragon_engine, motion, translation.targetgmd)
-
-    elif dst_gmt.new_bones:
-        # convert old bones to new bones (add _c_n and copy center movement to vector (and sync) accordingly)
-        for anm in in_file.animations:
-            anm.bones = old_to_new_bones(
-                anm.bones, src_gmt.new_bones, dst_gmt.is_dragon_engine, motion, translation.targetgmd)
+            if not dst_gmt.is_dragon_engine:
+                # convert values in kosi to be direct child of center
+                self.add_stage("de to old kosi", de_to_old_kosi)
+        elif dst_gmt.is_dragon_engine:
+            # convert values in kosi to be direct child of ketu
+            self.add_stage("old to de kosi", old_to_de_kosi)
+
+        if src_gmt.new_bones:
+            if not dst_gmt.new_bones or (src_gmt.is_dragon_engine and not dst_gmt.is_dragon_engine):
+                # convert new bones to old bones (remove _c_n and add vector (and sync) to center)
+                self.add_stage("new to old bones", lambda bones: new_to_old_bones(
+                    bones, src_gmt.is_dragon_engine, dst_gmt.new_bones, motion, translation.targetgmd))
+            elif not src_gmt.is_dragon_engine and dst_gmt.is_dragon_engine:
+                # convert post-Y5 bones to DE bones (copy center movement to vector)
+                self.add_stage("old to new bones", lambda bones: old_to_new_bones(
+                    bones, src_gmt.new_bones, dst_gmt.is_dragon_engine, motion, translation.targetgmd))
+
+        elif dst_gmt.new_bones:
+            # convert old bones to new bones (add _c_n and copy center movement to vector (and sync) accordingly)
+            self.add_stage("old to new bones", lambda bones: old_to_new_bones(
+                bones, src_gmt.new_bones, dst_gmt.is_dragon_engine, motion, translation.targetgmd))
+
+        if dst_gmt.new_bones and not dst_gmt.is_dragon_engine:
+            self.add_stage("finger positions", lambda bones: finger_pos(
+                bones, translation.targetgmd))
+
+        if translation.has_operation():
+            # the paths are asked for before any file is converted, never from a worker
+            if not translation.sourcegmd or not translation.targetgmd:
+                raise ValueError(
+                    "Source and target GMD paths are required for bone translation/reparenting")
+            self.add_stage("transform bones", lambda bones: transform_bones(
+                bones, src_gmt, dst_gmt, translation))
+
+        if translation.speed != "1":
+            self.add_stage(f"change speed x{translation.speed}", lambda bones: change_speed(
+                bones, translation.speed))
+
+    version: int
+    format_map: Dict[CurveFormat, CurveFormat]
+    name_map: Dict[str, str]
+    stages: List[Tuple[str, Callable[[List[Bone]], List[Bone]]]]
+
+    def add_stage(self, name: str, stage: Callable[[List[Bone]], List[Bone]]):
+        self.stages.append((name, stage))
+
+    def explain(self, tolerance=None) -> List[str]:
+        # tolerance is the keyframe reduction convert_file will be given, if any
+        reduce = ["reduce keyframes"] if tolerance is not None else []
+        return [name for name, _ in self.stages] + reduce + ["write"]
+
+
+# plans are keyed by every option that changes them
+PLANS = {}
+
+
+def conversion_plan(src_game, dst_game, motion, translation) -> ConversionPlan:
+    key = (src_game, dst_game, motion, tuple(sorted(vars(translation).items())))
+    plan = PLANS.get(key)
+    if plan is None:
+        plan = PLANS[key] = ConversionPlan(
+            src_game, dst_game, motion, translation)
+    return plan
+
+
+def add_cost(costs, stage: str, start: float) -> float:
+    now = perf_counter()
+    if costs is not None:
+        costs[stage] = costs.get(stage, 0.0) + now - start
+    return now
+
+
+def format_costs(costs) -> List[str]:
+    total = sum(costs.values())
+    return [f"{stage:<32} {cost * 1000:10.1f} ms {cost * 100 / (total or 1):6.1f}%" for stage, cost in costs.items()]
+
+
+def load_file(path, data=None, costs=None) -> GMTFile:
+    # data can hold the already loaded contents of path
+    start = perf_counter()
+    in_file = read_gmt(data) if data is not None else read_file(path)
+    add_cost(costs, "read", start)
+    # read_gmt returns nothing for a bad magic or an unsupported version
+    if in_file is None:
+        raise ValueError(f"{path}: not a GMT file")
+    return in_file
+
+
+def clone_file(in_file: GMTFile, costs=None) -> GMTFile:
+    start = perf_counter()
+    clone = in_file.clone()
+    add_cost(costs, "clone", start)
+    return clone
 
-    if dst_gmt.new_bones and not dst_gmt.is_dragon_engine:
-        # if not translation.targetgmd:
-        #    print("Target GMD path is required for hand pattern fixing")
-        #    translation.targetgmd = input("Target GMD path: ")
-        for anm in in_file.animations:
-            anm.bones = finger_pos(anm.bones, translation.targetgmd)
-
-    if translation.has_operation():
-        if not translation.sourcegmd or not translation.targetgmd:
-            print(
-                "Source and target GMD paths are required for bone translation/reparenting")
-            translation.sourcegmd = input("Source GMD path: ")
-            translation.targetgmd = input("Target GMD path: ")
-        for anm in in_file.animations:
-            anm.bones = transform_bones(
-                anm.bones, src_gmt, dst_gmt, translation)
 
-    if translation.speed != "1":
+# returns converted file as bytearray
+# or writes it to out_path and returns its size
+# the time spent in every stage is added to costs, if given
+# with dedup, identical curve data is shared and the bytes saved are added to stats
+# with a tolerance, keyframes are reduced before writing and the result of every curve is added to stats
+
+
+def convert(path, src_game, dst_game, motion, translation, out_path=None, data=None, costs=None, dedup=False, stats=None, tolerance=None) -> bytearray:
+    in_file = load_file(path, data, costs)
+    return convert_file(in_file, src_game, dst_game, motion, translation, out_path, costs, dedup, stats, tolerance)
+
+
+# converts an already parsed file in place
+def convert_file(in_file: GMTFile, src_game, dst_game, motion, translation, out_path=None, costs=None, dedup=False, stats=None, tolerance=None) -> bytearray:
+    plan = conversion_plan(src_game, dst_game, motion, translation)
+
+    start = perf_counter()
+    in_file.header.version = plan.version
+
+    for name, stage in plan.stages:
         for anm in in_file.animations:
-            anm.bones = change_speed(anm.bones, translation.speed)
+            anm.bones = stage(anm.bones)
+        start = add_cost(costs, name, start)
 
     """
     for b in in_file.animations[0].bones:
@@ -190,7 +276,15 @@ def convert(path, src_game, dst_game, motion, translation) -> bytearray:
             anm.bones = reset_hand_pos(anm.bones)
     """
 
-    return write_file(in_file, dst_gmt.version)
+    if tolerance is not None:
+        reductions = reduce_file(in_file, tolerance)
+        if stats is not None:
+            stats['reductions'] = stats.get('reductions', []) + reductions
+        start = add_cost(costs, "reduce keyframes", start)
+
+    result = write_file(in_file, plan.version, out_path, dedup, stats)
+    add_cost(costs, "write", start)
+    return result
 
 
 def old_to_de_kosi(bones: List[Bone]) -> List[Bone]:
@@ -208,7 +302,7 @@ def old_to_de_kosi(bones: List[Bone]) -> List[Bone]:
     positions = []
     for ko in kosi.position_curves():
         ko.values = [[0 for x in value] for value in ko.values]
-        positions.append(deepcopy(ko))
+        positions.append(ko)
     kosi_curves = positions
 
     rotations = []
@@ -218,23 +312,20 @@ def old_to_de_kosi(bones: List[Bone]) -> List[Bone]:
             c.values = [[0, 0, 0, 1] for v in c.values]
         kosi.curves.extend(curves)
     for ke, ko in zip(ketu.rotation_curves(), kosi.rotation_curves()):
-        i = 0
         ko.neutralize()
         ko.curve_format = FLOAT_TO_SCALED.get(ko.curve_format, ko.curve_format)
-        for f in ko.graph.keyframes:
-            kf = f
-            if kf not in ke.graph.keyframes:
-                kf = [k for k in ke.graph.keyframes if k < kf][-1]
+        indices = align_keyframes(ko.graph.keyframes, ke.graph.keyframes)
+        if len(indices):
             # TODO: if original value was two axes, can we export as 4 axes?
-            ke_value = curve_array_to_quat(
-                ke.curve_format, ke.values[ke.graph.keyframes.index(kf)])
-            ko_value = curve_array_to_quat(ko.curve_format, ko.values[i])
-            quat = (ke_value.inverse * ko_value)
-            ko.values[i] = [quat.x, quat.y, quat.z, quat.w]
-            i += 1
-        rotations.append(deepcopy(ko))
+            ke_quats = curve_values_to_quats(
+                ke.curve_format, ke.values)[indices]
+            ko_quats = curve_values_to_quats(
+                ko.curve_format, ko.values[:len(indices)])
+            ko.values = quaternion.multiply(quaternion.inverse(ke_quats), ko_quats).tolist() + ko.values[len(indices):]
+        rotations.append(ko)
     kosi_curves.extend(rotations)
-    bones[kosi_index].curves = deepcopy(kosi_curves)
+    # copied, so kosi does not share curves with ketu
+    bones[kosi_index].curves = [c.copy() for c in kosi_curves]
     # append rotation curves to list of curves
     return bones
 
@@ -255,13 +346,8 @@ def de_to_old_kosi(bones: List[Bone]) -> List[Bone]:
     if not len(kosi.position_curves()):
         positions = ketu.position_curves()
     for ke, ko in zip(ketu.position_curves(), kosi.position_curves()):
-        i = 0
-        for f in ko.graph.keyframes:
-            kf = f
-            if kf not in ke.graph.keyframes:
-                kf = [k for k in ke.graph.keyframes if k < kf][-1]
-            ko.values[i] = ke.values[ke.graph.keyframes.index(kf)]
-            i += 1
+        for i, k in enumerate(align_keyframes(ko.graph.keyframes, ke.graph.keyframes)):
+            ko.values[i] = ke.values[k]
         # TODO: if something break, it's probably because this does check for the curve order
         # order should be (pos, rot) and it assumes that there is only one curve for each
         positions.append(ko)
@@ -274,20 +360,16 @@ def de_to_old_kosi(bones: List[Bone]) -> List[Bone]:
             c.values = [[0, 0, 0, 1] for v in c.values]
         kosi.curves.extend(curves)
     for ke, ko in zip(ketu.rotation_curves(), kosi.rotation_curves()):
-        i = 0
         ko.neutralize()
         ko.curve_format = SCALED_TO_FLOAT.get(ko.curve_format, ko.curve_format)
-        for f in ko.graph.keyframes:
-            kf = f
-            if kf not in ke.graph.keyframes:
-                kf = [k for k in ke.graph.keyframes if k < kf][-1]
+        indices = align_keyframes(ko.graph.keyframes, ke.graph.keyframes)
+        if len(indices):
             # TODO: if original value was two axes, can we export as 4 axes?
-            ke_value = curve_array_to_quat(
-                ke.curve_format, ke.values[ke.graph.keyframes.index(kf)])
-            ko_value = curve_array_to_quat(ko.curve_format, ko.values[i])
-            quat = (ke_value * ko_value)
-            ko.values[i] = [quat.x, quat.y, quat.z, quat.w]
-            i += 1
+            ke_quats = curve_values_to_quats(
+                ke.curve_format, ke.values)[indices]
+            ko_quats = curve_values_to_quats(
+                ko.curve_format, ko.values[:len(indices)])
+            ko.values = quaternion.multiply(ke_quats, ko_quats).tolist() + ko.values[len(indices):]
         rotations.append(ko)
     kosi_curves.extend(rotations)
     bones[kosi_index].curves = kosi_curves
@@ -325,35 +407,35 @@ def old_to_new_bones(bones: List[Bone], src_new, dst_de, motion, gmd_path) -> Li
                             x, y, z, _ = gmd_center.global_pos
                     c_pos = c_pos[0]
                     c_pos.neutralize()
-                    c_pos.values = list(
-                        map(lambda p: (p[0] - x, p[1] - y, p[2] - z), c_pos.values))
+                    c_pos.values = position.offset(c_pos.values, (-x, -y, -z))
                     center.curves[0] = c_pos
                     vector.curves = center.curves
                     center.curves = []
             elif not src_new:
-                vector.curves = [c.to_horizontal() for c in deepcopy(
-                    center.position_curves())] + center.rotation_curves()
+                vector.curves = [c.copy().to_horizontal()
+                                 for c in center.position_curves()] + center.rotation_curves()
 
-                ketu.curves = [c.to_vertical() for c in deepcopy(
-                    center.position_curves())] + ketu.rotation_curves()
+                ketu.curves = [c.copy().to_vertical()
+                               for c in center.position_curves()] + ketu.rotation_curves()
 
                 center.curves = [new_pos_curve()]
 
         else:
             # Use both center and vector
-            vector.curves = [c.to_horizontal()
-                             for c in deepcopy(center.position_curves())]
-            vector.curves.extend(deepcopy(center.rotation_curves()))
+            vector.curves = [c.copy().to_horizontal()
+                             for c in center.position_curves()]
+            vector.curves.extend([c.copy()
+                                 for c in center.rotation_curves()])
 
             if motion:
-                center.curves = [c.to_vertical()
-                                 for c in deepcopy(center.position_curves())]
+                center.curves = [c.copy().to_vertical()
+                                 for c in center.position_curves()]
 
         if v_index != -1:
-            bones[v_index] = deepcopy(vector)
+            bones[v_index] = vector.copy(deep=True)
         else:
-            bones.insert(c_index + 1, deepcopy(vector))
-        bones[c_index] = deepcopy(center)
+            bones.insert(c_index + 1, vector.copy(deep=True))
+        bones[c_index] = center.copy(deep=True)
 
     return bones
 
@@ -377,7 +459,7 @@ def finger_pos(bones: List[Bone], gmd_path=None) -> List[Bone]:
             pos = new_pos_curve()
             pos.values = [(x, y, z)]
             finger.curves.insert(0, pos)
-        bones[index] = deepcopy(finger)
+        bones[index] = finger.copy(deep=True)
 
     return bones
 
@@ -403,7 +485,7 @@ def new_to_old_bones(bones: List[Bone], src_de, dst_new, motion, gmd_path) -> Li
             center.curves = [add_curve(c, v) for c, v in zip(pos, v_pos)]
             center.curves.extend(vector.rotation_curves())
 
-        bones[index] = deepcopy(center)
+        bones[index] = center.copy(deep=True)
         if not dst_new:
             bones.remove(vector)
 
@@ -452,8 +534,9 @@ def reset_vector(bones: List[Bone], new_bones, is_de=True, motion=False, offset=
         v_pos = v_pos[0]
 
         v_pos.neutralize()
-        v_pos.values = list(map(lambda v: (
-            v[0] - offset[0], v[1] - offset[1] + height, v[2] - offset[2]), v_pos.values))
+        # adding -0.0 leaves x and z exactly as they were, signed zeros included
+        v_pos.values = position.offset(
+            v_pos.values, tuple(-o for o in offset[:3]), (-0.0, height, -0.0))
 
         bones[v_index] = vector
     return bones
@@ -489,230 +572,18 @@ def translate_face_bones(anm_bones: List[Bone], source, target):
             t_pos = tuple(
                 map(lambda x, y: -x + y, t.global_pos, b_t.global_pos))
 
-            pos_curve.values = list(map(lambda f: [
-                                    f[0] + s_pos[0] + t_pos[0], f[1] + s_pos[1] + t_pos[1], f[2] + s_pos[2] + t_pos[2]], pos_curve.values))
+            pos_curve.values = position.offset(pos_curve.values, s_pos, t_pos)
 
-            gmt_bone.curves[0] = deepcopy(pos_curve)
-            anm_bones[gmt_index] = deepcopy(gmt_bone)
+            gmt_bone.curves[0] = pos_curve.copy()
+            anm_bones[gmt_index] = gmt_bone.copy(deep=True)
 
     return anm_bones
 
 
+# the plan is compiled once per skeleton pair, options and bone names, then reused
 def transform_bones(anm_bones: List[Bone], src_props, dst_props, translation):
-    source_gmd = read_gmd_bones(translation.sourcegmd)
-    target_gmd = read_gmd_bones(translation.targetgmd)
-    # TODO: now loop over all bones to check for their children
-    # if you find a common child (after the gmt rename, be sure to update the names),
-    # reparent its positions and rotations like you did with ketu and kosi
-    # then accordingly, reparent its children too etc
-
-    if translation.reparent:
-        """
-        print("source bones:")
-        for b in source_gmd:
-            print(f"    {b.name}")
-        print("target bones:")
-        for b in target_gmd:
-            print(f"    {b.name}")
-        """
-        for bone_t in target_gmd:
-            bone_s = [b for b in source_gmd if b.name == bone_t.name]
-            anm_bone = [b for b in anm_bones if b.name.string() == bone_t.name]
-
-            s_index = -1
-            if len(bone_s):
-                bone_s = bone_s[0]
-                s_index = source_gmd.index(bone_s)
-            else:
-                bone_s = GMDBone()
-
-            if not len(anm_bone):
-                continue
-            anm_bone = anm_bone[0]
-            gmt_index = anm_bones.index(anm_bone)
-
-            parent_s = bone_s.parent_recursive
-            parent_t = bone_t.parent_recursive
-            parent_s = parent_s[0] if len(parent_s) else GMDBone()
-            parent_t = parent_t[0] if len(parent_t) else GMDBone()
-
-            parent_new = [p for p in source_gmd if p.name == parent_t.name]
-            parent_new = parent_new[0] if len(parent_new) else parent_t
-
-            """
-            if bone_t.name == '_lip_top_side1_r_n':
-                print(f"\nanm_bone.name.string(): {anm_bone.name.string()}")
-                print(f"anm_bone.curves[0].values[0]: {anm_bone.curves[0].values[0]}")
-                print(f"bone_s.global_pos: {bone_s.global_pos}")
-                print(f"bone_t.global_pos: {bone_t.global_pos}\n")
-                
-                print(f"parent_s.name: {parent_s.name}")
-                print(f"parent_s.global_pos: {parent_s.global_pos}")
-                print(f"parent_t.name: {parent_t.name}")
-                print(f"parent_t.global_pos: {parent_t.global_pos}")
-                print(f"parent_new.name: {parent_new.name}")
-                print(f"parent_new.global_pos: {parent_new.global_pos}\n")
-            """
-
-            if s_index != -1:
-                source_gmd[s_index].parent_recursive.insert(0, parent_new)
-
-            # positions
-            pos_curve = anm_bone.position_curves()
-            if len(pos_curve):
-                pos_curve = pos_curve[0]
-                pos_curve.neutralize()
-                s_pos = tuple(
-                    map(lambda x, y: x - y, parent_s.global_pos, bone_s.global_pos))
-                s_pos_new = tuple(
-                    map(lambda x, y: -x + y, parent_new.global_pos, bone_s.global_pos))
-
-                pos_curve.values = list(map(lambda f:
-                                            [f[0] + s_pos[0] + s_pos_new[0],
-                                             f[1] + s_pos[1] + s_pos_new[1],
-                                                f[2] + s_pos[2] + s_pos_new[2]], pos_curve.values))
-                anm_bones[gmt_index].curves[0] = deepcopy(pos_curve)
-
-            """
-            #rotations
-            rot_curve = anm_bone.rotation_curves()
-            if len(rot_curve):
-                rot_curve = rot_curve[0]
-                
-                for p in bone_s.parent_recursive:
-                    anm_p = [b for b in anm_bones if b.name == p.name]
-            """
-
-    # FIXME: translation doesn't work correctly after reparenting
-    # possible fix: source_gmd should get updated with other fixes
-
-    # more correct fix: it should be updated with predicted bone position, not parent_t
-    def translate(start: str, stop=[]):
-        start_s = [b for b in source_gmd if start in b.name]
-
-        if not len(start_s):
-            return
-
-        stop_children = []
-        if len(stop):
-            for st in stop:
-                stop_s = [b for b in source_gmd if st in b.name]
-                if len(stop_s):
-                    stop_s = stop_s[0]
-                    stop_s.get_children_recursive()
-                    stop_children.extend(
-                        list(map(lambda b: b.name, stop_s.children_recursive)))
-                else:
-                    stop_s = []
-
-        start_s = start_s[0]
-        start_s.get_children_recursive()
-
-        for b_s in start_s.children_recursive:
-            if b_s.name in stop_children:
-                continue
-            b_t = [bone for bone in target_gmd if bone.name == b_s.name]
-            if not len(b_t):
-                continue
-            b_t = b_t[0]
-
-            p_s = b_s.parent_recursive
-            p_t = b_t.parent_recursive
-            p_s = p_s[0] if len(p_s) else GMDBone()
-            p_t = p_t[0] if len(p_t) else GMDBone()
-
-            if find_gmd_bone(p_s.name, b_t.parent_recursive)[0]:
-                p_t, _ = find_gmd_bone(p_s.name, b_t.parent_recursive)
-
-            gmt_bone = [bone for bone in anm_bones if bone.name.string()
-                        == b_s.name]
-            if not len(gmt_bone):
-                continue
-            gmt_bone = gmt_bone[0]
-            gmt_index = anm_bones.index(gmt_bone)
-
-            pos_curve = gmt_bone.position_curves()
-            if not len(pos_curve):
-                continue
-            pos_curve = pos_curve[0]
-            pos_curve.neutralize()
-            """
-            print(f"\ngmt_bone.name.string(): {gmt_bone.name.string()}")
-            print(f"gmt_bone.curves[0].values[0]: {gmt_bone.curves[0].values[0]}")
-            print(f"b_s.global_pos: {b_s.global_pos}")
-            print(f"b_t.global_pos: {b_t.global_pos}\n")
-            
-            print(f"p_s.name: {p_s.name}")
-            print(f"p_s.global_pos: {p_s.global_pos}")
-            print(f"p_t.name: {p_t.name}")
-            print(f"p_t.global_pos: {p_t.global_pos}")
-            """
-            s_pos = tuple(
-                map(lambda x, y: x - y, p_s.global_pos, b_s.global_pos))
-            t_pos = tuple(
-                map(lambda x, y: -x + y, p_t.global_pos, b_t.global_pos))
-
-            pos_curve.values = list(map(lambda f:
-                                        [f[0] + s_pos[0] + t_pos[0],
-                                         f[1] + s_pos[1] + t_pos[1],
-                                         f[2] + s_pos[2] + t_pos[2]], pos_curve.values))
-
-            anm_bones[gmt_index].curves[0] = deepcopy(pos_curve)
-
-        if 'face' in start and src_props < dst_props and dst_props.is_dragon_engine:
-            for side_name in ['_lip_side_r_n', '_lip_side_l_n']:
-                side_gmt = Bone()
-                side_gmt.name = Name(side_name)
-                side_pos = Curve()
-                side_pos.curve_format = CurveFormat.POS_VEC3
-
-                # TODO: we're assuming that these bones do exist
-                side_t, _ = find_gmd_bone(side_name, target_gmd)
-                if not side_t:
-                    continue
-                #side_t = [bone for bone in target_gmd if bone.name == side_name][0]
-
-                btm_name = '_lip_btm_side1_r_n' if 'r' in side_name else '_lip_btm_side1_l_n'
-                btm_gmt, _ = find_bone(btm_name, anm_bones)
-                if not btm_gmt:
-                    continue
-                #[bone for bone in anm_bones if bone.name.string() == btm_name][0]
-                btm_t, _ = find_gmd_bone(btm_name, target_gmd)
-                #[bone for bone in target_gmd if bone.name == btm_name][0]
-
-                btm_pos = btm_gmt.position_curves()
-                if not len(btm_pos):
-                    continue
-                btm_pos = btm_pos[0]
-
-                side_pos.graph = btm_pos.graph
-
-                side_pos.values = list(map(lambda f:
-                                           [f[0] - btm_t.global_pos[0] + side_t.global_pos[0],
-                                            f[1] - btm_t.global_pos[1] +
-                                            side_t.global_pos[1],
-                                               f[2] - btm_t.global_pos[2] + side_t.global_pos[2]], btm_pos.values))
-
-                side_gmt.curves.append(side_pos)
-                anm_bones.append(side_gmt)
-
-    if translation.face:
-        if dst_props.new_bones:
-            translate('face_c_n')
-        else:
-            translate('face')
-
-    if translation.hand:
-        translate('ude3_r_n')
-        translate('ude3_l_n')
-
-    if translation.body:
-        if dst_props.new_bones:
-            translate('center_c_n', ['face_c_n', 'ude3_r_n', 'ude3_l_n'])
-        else:
-            translate('center', ['face', 'ude3_r_n', 'ude3_l_n'])
-
-    return anm_bones
+    plan = retarget_plan(anm_bones, src_props, dst_props, translation)
+    return apply_plan(plan, anm_bones)
 
 
 def combine(paths, ext):
@@ -722,18 +593,13 @@ def combine(paths, ext):
     files = []
     i = 0
     if ext == 'gmt':
-        gmt_file = read_file(paths[0])
-        for path in paths[1:]:
-            gmt_next = read_file(path)
-            i += 1
-            result = gmt_file.merge(gmt_next)
-            if result == -1:
-                files.append(
-                    (write_file(gmt_file, gmt_file.header.version), i))
-                gmt_file = gmt_next
-                i = 0
-        if result != -1:
+        # every run of parts that fits in one file is merged in a single pass
+        parts = [read_file(path) for path in paths]
+        while len(parts):
+            gmt_file = parts[0]
+            i = gmt_file.merge_all(parts[1:])
             files.append((write_file(gmt_file, gmt_file.header.version), i))
+            parts = parts[i + 1:]
 
     elif ext == 'cmt':
         files = []
@@ -755,7 +621,8 @@ def combine(paths, ext):
 
 def vector_org(path, bones=None):
     if not bones:
-        gmt = read_file(path)
+        # only the first keyframes are needed
+        gmt = read_file(path, lazy=True)
         bones = gmt.animations[0].bones
 
     vector = [b for b in bones if 'vector' in b.name.string()]
@@ -773,7 +640,7 @@ def vector_org(path, bones=None):
             if len(c_pos):
                 c_pos = c_pos[0]
                 c_pos.neutralize()
-                c = c_pos.values[0][1]
+                c = c_pos.first_value()[1]
 
     v_pos = vector.position_curves()
     if not len(v_pos):
@@ -781,13 +648,16 @@ def vector_org(path, bones=None):
     v_pos = v_pos[0]
 
     v_pos.neutralize()
-    pos = v_pos.values[0]
+    pos = v_pos.first_value()
     pos = (pos[0], pos[1] + c, pos[2])
     return pos
 
 
-def reset_camera(path, offset, add_offset, is_de):
-    cmt = read_cmt_file(path)
+def reset_camera(path, offset, add_offset, is_de, out_path=None, data=None):
+    if data is not None:
+        cmt = parse_cmt_file(BinaryReader(data), path)
+    else:
+        cmt = read_cmt_file(path)
     height = add_offset
     if not is_de:
         height += 1.14
@@ -801,7 +671,7 @@ def reset_camera(path, offset, add_offset, is_de):
             data.pos_y -= offset[1] - height
             data.pos_z -= offset[2]
 
-    return write_cmt_file(cmt, cmt.header.version)
+    return write_cmt_file(cmt, cmt.header.version, out_path)
 
 
 def change_speed(bones, speed: str):
@@ -818,19 +688,28 @@ def change_speed(bones, speed: str):
     speed_mul //= divisor
     speed_div //= divisor
 
+    # curves share graphs, so every graph is retimed once and reassigned
     if speed_div != 1:
+        retimed = {}
         for bone in bones:
             for curve in bone.curves:
-                curve.graph.keyframes = list(map(lambda x: x * speed_div, curve.graph.keyframes))
+                if curve.graph not in retimed:
+                    retimed[curve.graph] = curve.graph.retime(
+                        [x * speed_div for x in curve.graph.keyframes])
+                curve.graph = retimed[curve.graph]
 
     if speed_mul != 1:
+        retimed = {}
         for bone in bones:
             for curve in bone.curves:
                 if len(curve.values) > 1:
                     last_value = curve.values[-1]
-                    last_key = curve.graph.keyframes[-1]
                     curve.values = curve.values[:-1][::speed_mul] + [last_value]
-                    curve.graph.keyframes = curve.graph.keyframes[:-1][::speed_mul] + [last_key]
-                    curve.graph.keyframes = list(map(lambda x: x // speed_mul, curve.graph.keyframes))
+                    if curve.graph not in retimed:
+                        last_key = curve.graph.keyframes[-1]
+                        keyframes = curve.graph.keyframes[:-1][::speed_mul] + (last_key,)
+                        retimed[curve.graph] = curve.graph.retime(
+                            [x // speed_mul for x in keyframes])
+                    curve.graph = retimed[curve.graph]
 
     return bones
@@ -1,10 +1,16 @@
 import argparse
 import os
 import io
+import json
 from typing import List
 
 from structure.version import GAME, GMT_VERSION, GMTProperties
-from converter import convert, combine, reset_camera, vector_org, Translation
+from converter import clone_file, combine, conversion_plan, convert_file, format_costs, load_file, vector_org, Translation
+from probe import scan
+from batch import Job, run_batch
+from util.read_gmd import set_gmd_cache_dir
+from manifest import Manifest, conversion_options, manifest_path
+from reduction import format_reductions
 
 description = """
 GMT Converter v0.5.4
@@ -45,10 +51,19 @@ If you want to convert an entire folder of GMTs, add the -d flag (or -dr to conv
 
 """
 
+def tolerance(value: str) -> float:
+    tolerance = float(value)
+    if tolerance < 0:
+        raise argparse.ArgumentTypeError(
+            f"tolerance cannot be negative: {value}")
+    return tolerance
+
+
 parser = argparse.ArgumentParser(
     description=description, epilog=epilog, formatter_class=argparse.RawDescriptionHelpFormatter)
 parser.add_argument('-ig', '--ingame', action='store', help='source game')
-parser.add_argument('-og', '--outgame', action='store', help='target game')
+parser.add_argument('-og', '--outgame', action='store',
+                    help='target game [a comma separated list (y0,y5,yk2) converts to each of them]')
 parser.add_argument('-i', '--inpath', action='store',
                     help='GMT input name (or input folder path)')
 parser.add_argument('-o', '--outpath', action='store', help='GMT output name')
@@ -83,13 +98,49 @@ parser.add_argument('-ns', '--nosuffix', action='store_true',
 parser.add_argument('-sf', '--safe', action='store_true',
                     help='ask before overwriting files')
 
+parser.add_argument('-j', '--jobs', action='store', type=int, default=1,
+                    help='number of files to convert in parallel with -d or -dr [0 uses all cores]')
+
+parser.add_argument('-rq', '--readqueue', action='store', type=int, default=2,
+                    help='number of input files to read ahead with -d or -dr')
+parser.add_argument('-wq', '--writequeue', action='store', type=int, default=2,
+                    help='number of converted files waiting to be written with -d or -dr')
+
+parser.add_argument('-inc', '--incremental', action='store_true',
+                    help='skip files that did not change since the last run with the same options [only with -d or -dr]')
+
+parser.add_argument('-gc', '--gmdcache', action='store',
+                    help='folder to keep parsed GMD skeletons and retarget plans in, to be reused by later runs')
+
+parser.add_argument('-exp', '--explain', action='store_true',
+                    help='print the conversion stages and the time spent in each of them')
+
+parser.add_argument('-dd', '--dedup', action='store_true',
+                    help='write identical curve data only once, and print how many bytes that saved')
+
+parser.add_argument('-rd', '--reduce', action='store', type=tolerance,
+                    help='remove keyframes that interpolation reproduces within this tolerance, 0 only removes exact repeats [per curve results are printed with -exp]')
+
 parser.add_argument('-cmb', '--combine', action='store_true',
                     help='combine split animations inside a directory (for pre-Y5 hacts) [WILL NOT CONVERT]')
 
+parser.add_argument('-prb', '--probe', action='store_true',
+                    help='print header info of the input file (or every GMT/GMD/CMT in the input folder tree) as JSON lines [WILL NOT CONVERT]')
+
 parser.add_argument('-sp', '--speed', action='store',
                     help='factor of the animations speed [2 will double the speed, 1/2 will change it to half the speed]')
 
 
+def target_path(path: str, game: str, nosuffix: bool, multiple: bool) -> str:
+    # output path of a converted file for one target game
+    # without a suffix, multiple targets are written into per-game folders
+    if nosuffix:
+        if multiple:
+            return os.path.join(os.path.dirname(path), game, os.path.basename(path))
+        return path
+    return path[:-4] + f"-{game}.gmt"
+
+
 def process_args(args):
     translation = Translation(args.reparent, args.face, args.hand, args.body,
                               args.sourcegmd, args.targetgmd, args.reset, args.resethact, args.addoffset, args.speed)
@@ -108,6 +159,11 @@ def process_args(args):
         collect(args.inpath, args.outpath, args.nosuffix)
         return 0
 
+    if args.probe:
+        for info in scan(args.inpath):
+            print(json.dumps(info), flush=True)
+        return 0
+
     if not args.ingame:
         args.ingame = input("Enter source game:\n")
     if not args.outgame:
@@ -115,6 +171,7 @@ def process_args(args):
 
     args.ingame = args.ingame.lower()
     args.outgame = args.outgame.lower()
+    args.outgames = [g.strip() for g in args.outgame.split(',') if g.strip()]
 
     if args.dir or args.recursive:
         args.dir = True
@@ -132,8 +189,14 @@ def process_args(args):
                     "Error: Provide an output path when using --nosuffix without -d or -dr")
                 os.system('pause')
                 return -1
-            args.outpath = args.inpath[:-4] + f"-{args.outgame}.gmt"
-        if args.inpath.lower() == args.outpath.lower():
+            args.outputs = [(g, target_path(args.inpath, g, False, True))
+                            for g in args.outgames]
+        elif len(args.outgames) == 1:
+            args.outputs = [(args.outgames[0], args.outpath)]
+        else:
+            args.outputs = [(g, target_path(args.outpath, g, args.nosuffix, True))
+                            for g in args.outgames]
+        if args.inpath.lower() in [o.lower() for _, o in args.outputs]:
             print(
                 "Error: Input path cannot be the same as output path when not using -d or -dr")
             os.system('pause')
@@ -143,20 +206,31 @@ def process_args(args):
         print(f"Error: Game \'{args.ingame}\' is not supported")
         os.system('pause')
         return -1
-    if args.outgame not in GAME:
-        print(f"Error: Game \'{args.outgame}\' is not supported")
-        os.system('pause')
-        return -1
-    if not translation.has_anything():
-        if args.ingame == args.outgame:
-            print(f"Error: Cannot convert to the same game")
-            os.system('pause')
-            return -1
-        if GMT_VERSION[GAME[args.ingame]] == GMT_VERSION[GAME[args.outgame]]:
-            print(
-                f"Error: Conversion is not needed between \'{args.ingame}\' and \'{args.outgame}\'")
+    for outgame in args.outgames:
+        if outgame not in GAME:
+            print(f"Error: Game \'{outgame}\' is not supported")
             os.system('pause')
             return -1
+        if not translation.has_anything():
+            if args.ingame == outgame:
+                print(f"Error: Cannot convert to the same game")
+                os.system('pause')
+                return -1
+            if GMT_VERSION[GAME[args.ingame]] == GMT_VERSION[GAME[outgame]]:
+                print(
+                    f"Error: Conversion is not needed between \'{args.ingame}\' and \'{outgame}\'")
+                os.system('pause')
+                return -1
+
+    if translation.has_operation() and not (translation.sourcegmd and translation.targetgmd):
+        print("Source and target GMD paths are required for bone translation/reparenting")
+        translation.sourcegmd = input("Source GMD path: ")
+        translation.targetgmd = input("Target GMD path: ")
+
+    set_gmd_cache_dir(args.gmdcache)
+
+    if args.jobs < 1:
+        args.jobs = os.cpu_count() or 1
 
     if translation.has_reset():
         translation.reset = False
@@ -174,17 +248,30 @@ def main():
         return processed
     args, translation = processed
 
+    if args.explain:
+        for outgame in args.outgames:
+            print(f"conversion stages ({args.ingame} to {outgame}):")
+            for stage in conversion_plan(args.ingame, outgame, args.motion, translation).explain(args.reduce):
+                print(f"    {stage}")
+
     if args.dir:
+        jobs = []
+        stopped = False
+        skipped = 0
+        manifest = None
+        if args.incremental:
+            manifest = Manifest(manifest_path(args.outpath),
+                                conversion_options(args, translation))
+        multiple = len(args.outgames) > 1
+        if multiple and args.nosuffix:
+            for outgame in args.outgames:
+                os.makedirs(os.path.join(args.outpath, outgame), exist_ok=True)
+
         for r, d, f in os.walk(args.inpath):
             for file in f:
                 gmt_file = os.path.join(r, file)
                 # if not gmt_file.startswith('\"'):
                 #    gmt_file = f"\"{gmt_file}\""
-                if args.nosuffix:
-                    output_file = os.path.join(args.outpath, file)
-                else:
-                    output_file = os.path.join(
-                        args.outpath, file[:-4] + f"-{args.outgame}.gmt")
 
                 stop = False
                 for g in GAME.keys():
@@ -194,51 +281,83 @@ def main():
                 if stop:
                     continue
 
-                if translation.resethact:
-                    if gmt_file.endswith('.cmt'):
-                        output_file = output_file[:-4] + '.cmt'
-                        is_de = GMTProperties(
-                            GAME[args.ingame]).is_dragon_engine
-                        with open(output_file, 'wb') as g:
-                            g.write(reset_camera(
-                                gmt_file, translation.offset, translation.add_offset, is_de))
-                            print(f"converted {output_file}")
-                        continue
-
-                if not gmt_file.endswith('.gmt'):
+                is_camera = translation.resethact and gmt_file.endswith('.cmt')
+                if not is_camera and not gmt_file.endswith('.gmt'):
                     continue
 
-                if args.safe and os.path.isfile(output_file):
-                    print(
-                        f"Output file \"{output_file}\" already exists. Overwrite? (select 's' to stop conversion)")
-                    result = input("(y/n/s) ").lower()
-                    if result != 'y':
-                        if result == 's':
-                            print("Stopping operation...")
-                            os.system('pause')
-                            return -1
-                        print(f"Skipping \"{output_file}\"...")
+                outputs = []
+                for outgame in args.outgames:
+                    output_file = target_path(os.path.join(
+                        args.outpath, file), outgame, args.nosuffix, multiple)
+                    if is_camera:
+                        output_file = output_file[:-4] + '.cmt'
+
+                    if manifest and manifest.is_current(gmt_file, output_file, outgame):
+                        skipped += 1
                         continue
-                with open(output_file, 'wb') as g:
-                    g.write(convert(gmt_file, args.ingame,
-                                    args.outgame, args.motion, translation))
-                    print(f"converted {output_file}")
-            if not args.recursive:
+
+                    if args.safe and not is_camera and os.path.isfile(output_file):
+                        print(
+                            f"Output file \"{output_file}\" already exists. Overwrite? (select 's' to stop conversion)")
+                        result = input("(y/n/s) ").lower()
+                        if result != 'y':
+                            if result == 's':
+                                stopped = True
+                                break
+                            print(f"Skipping \"{output_file}\"...")
+                            continue
+                    outputs.append((outgame, output_file))
+                if stopped:
+                    break
+
+                if len(outputs):
+                    jobs.append(Job(gmt_file, outputs, is_camera))
+            if stopped or not args.recursive:
                 break
+
+        if skipped:
+            print(f"skipped {skipped} unchanged files")
+
+        run_batch(jobs, args, translation, args.jobs,
+                  args.readqueue, args.writequeue, manifest)
+
+        if stopped:
+            print("Stopping operation...")
+            os.system('pause')
+            return -1
     else:
-        if args.safe and os.path.isfile(args.outpath):
-            print(f"Output file \"{args.outpath}\" already exists. Overwrite?")
-            result = input("(y/n) ").lower()
-            if result != 'y':
-                print("Stopping operation...")
-                os.system('pause')
-                return
+        for _, output_file in args.outputs:
+            if args.safe and os.path.isfile(output_file):
+                print(f"Output file \"{output_file}\" already exists. Overwrite?")
+                result = input("(y/n) ").lower()
+                if result != 'y':
+                    print("Stopping operation...")
+                    os.system('pause')
+                    return
         # if not args.inpath.startswith('\"'):
         #    args.inpath = f"\"{args.inpath}\""
-        with open(args.outpath, 'wb') as g:
-            g.write(convert(args.inpath, args.ingame,
-                            args.outgame, args.motion, translation))
-            print(f"converted {args.outpath}")
+        costs = {} if args.explain else None
+        stats = {} if args.dedup or args.reduce is not None else None
+        # parsed once, every target but the last converts a clone
+        in_file = load_file(args.inpath, costs=costs)
+        for i, (outgame, output_file) in enumerate(args.outputs):
+            if args.nosuffix and len(args.outputs) > 1:
+                os.makedirs(os.path.dirname(output_file), exist_ok=True)
+            gmt = clone_file(in_file, costs) if i < len(
+                args.outputs) - 1 else in_file
+            convert_file(gmt, args.ingame, outgame, args.motion, translation,
+                         output_file, costs=costs, dedup=args.dedup, stats=stats, tolerance=args.reduce)
+            print(f"converted {output_file}")
+        if stats and 'reductions' in stats:
+            for line in format_reductions(stats['reductions'], args.explain):
+                print(line)
+        if stats and 'dedup saved' in stats:
+            print(
+                f"deduplicated curve data saved {stats['dedup saved']} bytes")
+        if costs:
+            print("stage costs:")
+            for line in format_costs(costs):
+                print(f"    {line}")
     print("DONE")
 
 
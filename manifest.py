@@ -0,0 +1,119 @@
+import hashlib
+import json
+import os
+from os.path import abspath, isfile, realpath
+from typing import Any, Dict
+
+from converter import CONVERTER_VERSION
+
+
+def data_hash(data: bytes) -> str:
+    return hashlib.sha1(data).hexdigest()
+
+
+def file_hash(path: str) -> str:
+    try:
+        with open(realpath(path), "rb") as f:
+            return data_hash(f.read())
+    except OSError:
+        return None
+
+
+def manifest_path(outpath: str) -> str:
+    # kept next to the output folder, so it is never picked up as an input
+    return abspath(outpath) + ".manifest.json"
+
+
+def conversion_options(args, translation) -> Dict[str, Any]:
+    # everything that changes the output of a file besides its own contents
+    options = {
+        'version': CONVERTER_VERSION,
+        'ingame': args.ingame,
+        'motion': args.motion,
+        'nosuffix': args.nosuffix,
+        'translation': vars(translation),
+        'sourcegmd_hash': file_hash(translation.sourcegmd) if translation.sourcegmd else None,
+        'targetgmd_hash': file_hash(translation.targetgmd) if translation.targetgmd else None,
+    }
+    # only kept when set, so manifests written without them stay valid
+    if args.dedup:
+        options['dedup'] = True
+    if args.reduce is not None:
+        options['reduce'] = args.reduce
+    # normalize tuples and numbers the same way they are loaded back
+    return json.loads(json.dumps(options))
+
+
+class Manifest:
+    # inputs are compared by size and mtime first, and only hashed when those changed
+    # the target game is kept per output, so adding a target does not invalidate the rest
+    # any change in the conversion options invalidates every entry
+    # records are saved every save_every outputs, so an interrupted batch keeps most of them
+
+    def __init__(self, path: str, options: Dict[str, Any], save_every=50):
+        self.path = path
+        self.options = options
+        self.files = {}
+        self.save_every = save_every
+        self.unsaved = 0
+
+        try:
+            with open(path, "r") as f:
+                manifest = json.load(f)
+            if manifest.get('options') == options:
+                self.files = manifest['files']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    path: str
+    options: Dict[str, Any]
+    files: Dict[str, Dict[str, Any]]  # keyed by output path
+    save_every: int
+    unsaved: int  # records since the last save
+
+    def __unchanged(self, path: str, size: int, mtime: int, hash: str) -> bool:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        if stat.st_size != size:
+            return False
+        if stat.st_mtime_ns == mtime:
+            return True
+        return file_hash(path) == hash
+
+    def is_current(self, path: str, output: str, game: str) -> bool:
+        entry = self.files.get(output)
+        if not entry or entry['input'] != path or entry.get('game') != game or not isfile(output):
+            return False
+        return (self.__unchanged(path, entry['size'], entry['mtime'], entry['hash'])
+                and self.__unchanged(output, entry['output_size'], entry['output_mtime'], entry['output_hash']))
+
+    def record(self, path: str, output: str, game: str, source, out: bytes):
+        # source is the (size, mtime, hash) of the input when it was read
+        stat = os.stat(output)
+        self.files[output] = {
+            'input': path,
+            'game': game,
+            'size': source[0],
+            'mtime': source[1],
+            'hash': source[2],
+            'output_size': stat.st_size,
+            'output_mtime': stat.st_mtime_ns,
+            'output_hash': data_hash(out),
+        }
+        self.unsaved += 1
+
+    def discard(self, output: str):
+        self.files.pop(output, None)
+
+    def checkpoint(self):
+        if self.unsaved >= self.save_every:
+            self.save()
+
+    def save(self):
+        temp = self.path + ".tmp"
+        with open(temp, "w") as f:
+            json.dump({'options': self.options, 'files': self.files}, f, indent=1)
+        os.replace(temp, self.path)
+        self.unsaved = 0
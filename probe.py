@@ -0,0 +1,131 @@
+import os
+from collections import Counter
+from typing import Any, Dict, Iterator
+
+from read import read_header, read_names
+from structure.animation import ANIMATION_LAYOUT
+from structure.curve import CURVE_LAYOUT
+from structure.types.format import parse_format
+from util.binary import BinaryReader, map_file
+from util.read_cmt import read_header as read_cmt_header
+
+GMT_VERSIONS = [0x20002, 0x20001, 0x20000, 0x10001]
+CMT_VERSIONS = [0x40000, 0x20000, 0x10001]
+
+# probes only read the header and the fixed size tables of a file
+# keyframe and animation data are never touched
+
+
+def probe_gmt(gmt: BinaryReader) -> Dict[str, Any]:
+    if gmt.read_str(4) != "GSGT":
+        return {'error': "Invalid magic"}
+
+    header = read_header(gmt)
+    info = {
+        'version': hex(header.version),
+        'big_endian': header.big_endian,
+        'file_name': header.file_name.string(),
+    }
+    if header.version not in GMT_VERSIONS:
+        info['error'] = "Unsupported version"
+        return info
+
+    names = read_names(gmt, header)
+
+    animations = []
+    for i in range(header.anm_count):
+        gmt.seek(header.anm_offset + (i * ANIMATION_LAYOUT.size))
+        anm = gmt.read_record(ANIMATION_LAYOUT)
+        animations.append({
+            'name': names[i].string(),
+            'frame_count': anm['frame_count'],
+            'frame_rate': anm['frame_rate'],
+            'bone_count': anm['bone_map_count'],
+            'curve_count': anm['curve_count'],
+        })
+
+    formats = Counter()
+    for i in range(header.curve_count):
+        gmt.seek(header.curve_offset + (i * CURVE_LAYOUT.size))
+        curve = gmt.read_record(CURVE_LAYOUT)
+        formats[parse_format(curve['property_fmt'],
+                             curve['format'], header.version).name] += 1
+
+    info['animations'] = animations
+    info['bone_count'] = header.bone_map_count
+    info['curve_count'] = header.curve_count
+    info['graph_count'] = header.graph_count
+    info['curve_formats'] = dict(formats)
+    return info
+
+
+def probe_gmd(gmd: BinaryReader) -> Dict[str, Any]:
+    if gmd.read_str(4) != "GSGM":
+        return {'error': "Invalid GMD magic"}
+
+    gmd.skip(1)
+    big_endian = bool(gmd.read_uint8())
+    gmd.set_endian(big_endian)
+
+    gmd.seek(0x5C)
+    return {
+        'big_endian': big_endian,
+        'bone_count': gmd.read_uint32(),
+    }
+
+
+def probe_cmt(cmt: BinaryReader) -> Dict[str, Any]:
+    if cmt.read_str(4) != "CMTP":
+        return {'error': "Invalid magic"}
+
+    header = read_cmt_header(cmt)
+    info = {
+        'version': hex(header.version),
+        'big_endian': header.big_endian,
+    }
+    if header.version not in CMT_VERSIONS:
+        info['error'] = "Unsupported version"
+        return info
+
+    animations = []
+    for i in range(header.anm_count):
+        cmt.seek((i * 0x10) + 0x20)
+        animations.append({
+            'frame_rate': cmt.read_float(),
+            'frame_count': cmt.read_uint32(),
+        })
+    info['animations'] = animations
+    return info
+
+
+PROBES = {
+    '.gmt': probe_gmt,
+    '.gmd': probe_gmd,
+    '.cmt': probe_cmt,
+}
+
+
+def probe_file(path: str) -> Dict[str, Any]:
+    ext = os.path.splitext(path)[1].lower()
+    info = {'path': path, 'type': ext[1:], 'size': None}
+    try:
+        info['size'] = os.path.getsize(path)
+        with map_file(path) as buffer:
+            info.update(PROBES[ext](BinaryReader(buffer)))
+    except Exception as e:
+        # unreadable files, truncated or corrupted tables
+        info['error'] = f"{type(e).__name__}: {e}"
+    return info
+
+
+def scan(path: str) -> Iterator[Dict[str, Any]]:
+    # yields one probe per GMT/GMD/CMT file in the directory tree (or the single file)
+    if not os.path.isdir(path):
+        yield probe_file(path)
+        return
+
+    for r, d, f in os.walk(path):
+        d.sort()
+        for file in sorted(f):
+            if os.path.splitext(file)[1].lower() in PROBES:
+                yield probe_file(os.path.join(r, file))
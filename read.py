@@ -1,16 +1,15 @@
-import struct
 from os.path import realpath
-from math import sqrt
-from copy import deepcopy
 from typing import List, Any
 
-from util.binary import BinaryReader
+import numpy
+
+from util.binary import BinaryReader, Buffer, map_file
 from structure.types.format import CurveFormat, parse_format
 from structure.file import GMTFile
-from structure.header import GMTHeader
-from structure.animation import Animation
+from structure.header import GMTHeader, HEADER_LAYOUT
+from structure.animation import Animation, ANIMATION_LAYOUT
 from structure.bone import Bone
-from structure.curve import Curve
+from structure.curve import Curve, CURVE_LAYOUT
 from structure.graph import Graph
 from structure.name import Name
 
@@ -22,37 +21,12 @@ def read_header(gmt: BinaryReader) -> GMTHeader:
     header.big_endian = bool(gmt.read_uint8())
     gmt.set_endian(header.big_endian)
     gmt.skip(2)
-    header.version = gmt.read_uint32()
-    header.data_size = gmt.read_uint32()
-    gmt.skip(2)
-    header.file_name = Name(str(gmt.read_str(30)))
-
-    header.anm_count = gmt.read_uint32()
-    header.anm_offset = gmt.read_uint32()
-
-    header.graph_count = gmt.read_uint32()
-    header.graph_offset = gmt.read_uint32()
-
-    header.graph_data_size = gmt.read_uint32()
-    header.graph_data_offset = gmt.read_uint32()
 
-    header.name_count = gmt.read_uint32()
-    header.name_offset = gmt.read_uint32()
+    record = gmt.read_record(HEADER_LAYOUT)
+    record.pop('file_name_checksum')
+    record['file_name'] = Name(record['file_name'])
+    vars(header).update(record)
 
-    header.anm_map_count = gmt.read_uint32()
-    header.anm_map_offset = gmt.read_uint32()
-
-    header.bone_map_count = gmt.read_uint32()
-    header.bone_map_offset = gmt.read_uint32()
-
-    header.curve_count = gmt.read_uint32()
-    header.curve_offset = gmt.read_uint32()
-
-    header.anm_data_size = gmt.read_uint32()
-    header.anm_data_offset = gmt.read_uint32()
-
-    gmt.skip(12)
-    header.flags = gmt.read_uint32()
     return header
 
 
@@ -69,164 +43,136 @@ def read_names(gmt: BinaryReader, header: GMTHeader) -> List[str]:
 
 
 def read_graphs(gmt: BinaryReader, header: GMTHeader) -> List[Graph]:
+    # identical graphs are interned, so curves that share keyframes share a graph
+    pool = {}
     graph_list = []
     for i in range(header.graph_count):
-        graph = Graph()
-
         gmt.seek(header.graph_offset + (i * 4))
 
         gmt.seek(gmt.read_uint32())
-        for k in range(gmt.read_uint16()):
-            graph.keyframes.append(gmt.read_uint16())
+        keyframes = tuple(gmt.read_array("H", gmt.read_uint16()).tolist())
+        delimiter = gmt.read_int16()
 
-        graph.delimiter = gmt.read_int16()
+        graph = pool.get((keyframes, delimiter))
+        if not graph:
+            graph = pool[(keyframes, delimiter)] = Graph(keyframes, delimiter)
 
         graph_list.append(graph)
 
     return graph_list
 
 
-def read_animation_data(gmt: BinaryReader, format: CurveFormat, count: int) -> List[Any]:
-    value_list = []
+# component indices stored in the packed fields for each axis order
+# the component at the axis order index itself is reconstructed
+QUAT_INT_AXES = numpy.array([[1, 2, 3], [0, 2, 3], [0, 1, 3], [0, 1, 2]])
+
+
+def read_quat_int_scaled(gmt: BinaryReader, count: int) -> numpy.ndarray:
+    base_quaternion = gmt.read_array("h", 4) / 32_768
+    scale_quaternion = gmt.read_array("H", 4) / 32_768
+
+    f = gmt.read_array("I", count).astype(numpy.int64)
+    axis_order = f & 3
+    f = f >> 2
+
+    # three 10 bit fields, multiplied by 2^-30, 2^-20 and 2^-10 respectively
+    fields = numpy.column_stack((
+        (f & 0x3FF00000) * 2.0 ** -30,
+        (f & 0x000FFC00) * 2.0 ** -20,
+        (f & 0x000003FF) * 2.0 ** -10))
+
+    axes = QUAT_INT_AXES[axis_order]
+    fields = (fields * scale_quaternion[axes]) + base_quaternion[axes]
+
+    missing = 1.0 - ((fields[:, 0] ** 2) + (fields[:, 1] ** 2) + (fields[:, 2] ** 2))
+    missing = numpy.sqrt(numpy.where(missing > 0, missing, 0.0))
+
+    rows = numpy.arange(count)
+    value_list = numpy.empty((count, 4))
+    value_list[rows[:, None], axes] = fields
+    value_list[rows, axis_order] = missing
+
+    return value_list
 
+
+def read_animation_array(gmt: BinaryReader, format: CurveFormat, count: int) -> numpy.ndarray:
+    # decodes the whole value block of a curve at once
+    # returns a (count, components) array copied out of the reader's buffer
     if format == CurveFormat.POS_VEC3:
-        for k in range(count):
-            value_list.append([*gmt.read_float(3)])
+        values = gmt.read_array("f", count * 3).reshape(count, 3)
     elif format in [CurveFormat.POS_X, CurveFormat.POS_Y, CurveFormat.POS_Z]:
-        for k in range(count):
-            value_list.append([gmt.read_float()])
+        values = gmt.read_array("f", count).reshape(count, 1)
 
     elif format == CurveFormat.ROT_QUAT_SCALED:
-        for k in range(count):
-            value_list.append([(x / 16_384) for x in gmt.read_int16(4)])
+        values = gmt.read_array("h", count * 4).reshape(count, 4) / 16_384
     elif 'W_SCALED' in format.name:
-        for k in range(count):
-            value_list.append([(x / 16_384) for x in gmt.read_int16(2)])
+        values = gmt.read_array("h", count * 2).reshape(count, 2) / 16_384
 
     elif format == CurveFormat.ROT_QUAT_XYZ_FLOAT:
-        for k in range(count):
-            xyz = gmt.read_float(3)
-            x = (xyz[0] ** 2)
-            y = (xyz[1] ** 2)
-            z = (xyz[2] ** 2)
-            w = 1.0 - (x + y + z)
-            w = sqrt(w) if w > 0 else 0
-            value_list.append([*xyz, w])
+        xyz = gmt.read_array("f", count * 3).reshape(count, 3).astype(numpy.float64)
+        w = 1.0 - ((xyz[:, 0] ** 2) + (xyz[:, 1] ** 2) + (xyz[:, 2] ** 2))
+        w = numpy.sqrt(numpy.where(w > 0, w, 0.0))
+        values = numpy.column_stack((xyz, w))
     elif 'W_FLOAT' in format.name:
-        for k in range(count):
-            value_list.append([*gmt.read_float(2)])
+        values = gmt.read_array("f", count * 2).reshape(count, 2)
 
     elif format == CurveFormat.ROT_QUAT_HALF_FLOAT:
-        for k in range(count):
-            value_list.append([*gmt.read_half_float(4)])
+        values = gmt.read_array("e", count * 4).reshape(count, 4)
     elif 'W_HALF_FLOAT' in format.name:
-        for k in range(count):
-            value_list.append([*gmt.read_half_float(2)])
+        values = gmt.read_array("e", count * 2).reshape(count, 2)
 
     elif format == CurveFormat.ROT_QUAT_INT_SCALED:
-        base_quaternion = [(x / 32_768) for x in gmt.read_int16(4)]
-        scale_quaternion = [(x / 32_768) for x in gmt.read_uint16(4)]
-        for k in range(count):
-            f = gmt.read_uint32()
-            axis_order = f & 3
-            f = f >> 2
-
-            a1 = 0x3FF00000
-            a2 = 0x000FFC00
-            a3 = 0x000003FF
-
-            m1 = struct.unpack(">f", b'\x30\x80\x00\x00')[0]
-            m2 = struct.unpack(">f", b'\x35\x80\x00\x00')[0]
-            m3 = struct.unpack(">f", b'\x3A\x80\x00\x00')[0]
-
-            if not axis_order:
-                # x
-                y = float(f & a1) * m1
-                z = float(f & a2) * m2
-                w = float(f & a3) * m3
-
-                y = (y * scale_quaternion[1]) + base_quaternion[1]
-                z = (z * scale_quaternion[2]) + base_quaternion[2]
-                w = (w * scale_quaternion[3]) + base_quaternion[3]
-
-                x = 1.0 - ((y ** 2) + (z ** 2) + (w ** 2))
-                x = sqrt(x) if x > 0 else 0
-
-            elif axis_order == 1:
-                x = float(f & a1) * m1
-                # y
-                z = float(f & a2) * m2
-                w = float(f & a3) * m3
-
-                x = (x * scale_quaternion[0]) + base_quaternion[0]
-                z = (z * scale_quaternion[2]) + base_quaternion[2]
-                w = (w * scale_quaternion[3]) + base_quaternion[3]
-
-                y = 1.0 - ((x ** 2) + (z ** 2) + (w ** 2))
-                y = sqrt(y) if y > 0 else 0
-
-            elif axis_order == 2:
-                x = float(f & a1) * m1
-                y = float(f & a2) * m2
-                # z
-                w = float(f & a3) * m3
-
-                x = (x * scale_quaternion[0]) + base_quaternion[0]
-                y = (y * scale_quaternion[1]) + base_quaternion[1]
-                w = (w * scale_quaternion[3]) + base_quaternion[3]
-
-                z = 1.0 - ((x ** 2) + (y ** 2) + (w ** 2))
-                z = sqrt(z) if z > 0 else 0
-
-            elif axis_order == 3:
-                x = float(f & a1) * m1
-                y = float(f & a2) * m2
-                z = float(f & a3) * m3
-                # w
-
-                x = (x * scale_quaternion[0]) + base_quaternion[0]
-                y = (y * scale_quaternion[1]) + base_quaternion[1]
-                z = (z * scale_quaternion[2]) + base_quaternion[2]
-
-                w = 1.0 - ((x ** 2) + (y ** 2) + (z ** 2))
-                w = sqrt(w) if w > 0 else 0
-
-            value_list.append([x, y, z, w])
+        values = read_quat_int_scaled(gmt, count)
 
     elif 'PAT1' in format.name:
-        for k in range(count):
-            value_list.append([*gmt.read_int16(2)])
+        values = gmt.read_array("h", count * 2).reshape(count, 2)
 
     elif 'PAT2' in format.name:
-        for k in range(count):
-            value_list.append([gmt.read_int8(1)])
+        values = gmt.read_array("b", count).reshape(count, 1)
 
     # TODO: anything else should still be patterns (?)
     else:
-        for k in range(count):
-            value_list.append([gmt.read_int8(1)])
+        values = gmt.read_array("b", count).reshape(count, 1)
 
-    return value_list
+    if values.dtype.kind == 'f':
+        return numpy.ascontiguousarray(values, dtype=numpy.float64)
+    return values.astype(numpy.int64)
+
+
+def read_animation_data(gmt: BinaryReader, format: CurveFormat, count: int) -> List[Any]:
+    return read_animation_array(gmt, format, count).tolist()
 
 
-def read_curves(gmt: BinaryReader, file: GMTFile) -> List[Curve]:
+def lazy_animation_data(gmt: BinaryReader, offset: int, format: CurveFormat):
+    def decode(count: int) -> List[Any]:
+        gmt.seek(offset)
+        return read_animation_data(gmt, format, count)
+    return decode
+
+
+def read_curves(gmt: BinaryReader, file: GMTFile, lazy=False) -> List[Curve]:
     curve_list = []
     for i in range(file.header.curve_count):
         curve = Curve()
 
-        gmt.seek(file.header.curve_offset + (i * 16))
-
-        curve.graph = deepcopy(file.graphs[gmt.read_uint32()])
-        curve.anm_data_offset = gmt.read_uint32()
-        curve.property_fmt = gmt.read_uint32()
-        curve.format = gmt.read_uint32()
+        gmt.seek(file.header.curve_offset + (i * CURVE_LAYOUT.size))
 
-        gmt.seek(curve.anm_data_offset)
+        record = gmt.read_record(CURVE_LAYOUT)
+        curve.graph = file.graphs[record['graph_index']]
+        curve.anm_data_offset = record['anm_data_offset']
+        curve.property_fmt = record['property_fmt']
+        curve.format = record['format']
 
         curve.curve_format = parse_format(
             curve.property_fmt, curve.format, file.header.version)
-        curve.values = read_animation_data(
-            gmt, curve.curve_format, len(curve.graph.keyframes))
+
+        if lazy:
+            curve.set_source(lazy_animation_data(
+                gmt, curve.anm_data_offset, curve.curve_format))
+        else:
+            gmt.seek(curve.anm_data_offset)
+            curve.values = read_animation_data(
+                gmt, curve.curve_format, len(curve.graph.keyframes))
 
         curve_list.append(curve)
 
@@ -252,35 +198,15 @@ def read_bones(gmt: BinaryReader, file: GMTFile) -> List[Bone]:
 
 
 def read_animations(gmt: BinaryReader, file: GMTFile) -> List[Animation]:
+    curve_indices = {c: i for i, c in enumerate(file.curves)}
+
     anm_list = []
     for i in range(file.header.anm_count):
         anm = Animation()
 
-        gmt.seek(file.header.anm_offset + (i * 64))
-        gmt.skip(4)
+        gmt.seek(file.header.anm_offset + (i * ANIMATION_LAYOUT.size))
 
-        anm.frame_count = gmt.read_uint32()
-        anm.index = gmt.read_uint32()  # name_index?
-        anm.frame_rate = gmt.read_float()
-
-        anm.index1 = gmt.read_uint32()
-        anm.index2 = gmt.read_uint32()
-
-        anm.bone_map_start = gmt.read_uint32()
-        anm.bone_map_count = gmt.read_uint32()
-
-        anm.curve_count = gmt.read_uint32()
-
-        anm.index3 = gmt.read_uint32()  # graph_index?
-        anm.graph_count = gmt.read_uint32()
-
-        anm.anm_data_size = gmt.read_uint32()
-        anm.anm_data_offset = gmt.read_uint32()
-
-        anm.graph_data_size = gmt.read_uint32()
-        anm.graph_data_offset = gmt.read_uint32()
-
-        gmt.skip(4)
+        vars(anm).update(gmt.read_record(ANIMATION_LAYOUT))
 
         anm.name = file.names[i]
 
@@ -294,8 +220,8 @@ def read_animations(gmt: BinaryReader, file: GMTFile) -> List[Animation]:
         for g in range(anm.graph_count):
             anm.graphs.append(file.graphs[start + g])
 
-        start = file.curves.index(
-            [b.curves for b in anm.bones if len(b.curves)][0][0])
+        start = curve_indices[
+            [b.curves for b in anm.bones if len(b.curves)][0][0]]
         for c in range(anm.curve_count):
             anm.curves.append(file.curves[start + c])
 
@@ -304,12 +230,10 @@ def read_animations(gmt: BinaryReader, file: GMTFile) -> List[Animation]:
     return anm_list
 
 
-def read_file(path: str) -> GMTFile:
+def read_gmt(buffer: Buffer, lazy=False) -> GMTFile:
     file = GMTFile()
 
-    f = open(realpath(path), "rb")
-    gmt = BinaryReader(f.read())
-    f.close()
+    gmt = BinaryReader(buffer)
 
     if gmt.read_str(4) != "GSGT":
         print("Invalid magic!")
@@ -325,10 +249,22 @@ def read_file(path: str) -> GMTFile:
 
     file.graphs = read_graphs(gmt, file.header)
 
-    file.curves = read_curves(gmt, file)
+    file.curves = read_curves(gmt, file, lazy)
 
     file.bones = read_bones(gmt, file)
 
     file.animations = read_animations(gmt, file)
 
     return file
+
+
+# lazy files only decode curve values when they are accessed
+# metadata and first keyframes can be read without a full parse
+def read_file(path: str, lazy=False) -> GMTFile:
+    if lazy:
+        # the buffer has to outlive the parse, so it cannot be a mapping
+        with open(realpath(path), "rb") as f:
+            return read_gmt(f.read(), lazy)
+
+    with map_file(path) as buffer:
+        return read_gmt(buffer)
@@ -0,0 +1,228 @@
+import struct
+from typing import List
+
+import numpy
+
+from structure.curve import Curve
+from structure.file import GMTFile
+from structure.types.format import curve_values_to_quats
+from util import quaternion
+from write import data_format
+
+
+# interpolation of a curve between two keyframes
+LINEAR = 0  # positions and anything else with float values
+SLERP = 1  # rotations
+STEP = 2  # patterns, which are never interpolated
+
+
+class CurveReduction:
+    def __init__(self, bone: str, curve_format: str, before: int, after: int, size_before: int, size_after: int, max_error: float):
+        self.bone = bone
+        self.curve_format = curve_format
+        self.before = before
+        self.after = after
+        self.size_before = size_before
+        self.size_after = size_after
+        self.max_error = max_error
+
+    bone: str
+    curve_format: str
+    before: int  # keyframes
+    after: int
+    size_before: int  # bytes of animation data
+    size_after: int
+    max_error: float  # largest difference of a removed keyframe from its interpolated value
+
+
+def interpolation(curve: Curve) -> int:
+    if 'PAT' in curve.curve_format.name:
+        return STEP
+    if 'ROT' in curve.curve_format.name:
+        return SLERP
+    return LINEAR
+
+
+def curve_array(curve: Curve, kind=LINEAR) -> numpy.ndarray:
+    # rotations are compared as unit quaternions, everything else as stored
+    if kind == SLERP:
+        return quaternion.normalize(curve_values_to_quats(curve.curve_format, curve.values))
+    return numpy.array(curve.values, dtype=float).reshape(len(curve.values), -1)
+
+
+def interpolation_error(kind: int, first: numpy.ndarray, last: numpy.ndarray, inner: numpy.ndarray, t: numpy.ndarray) -> numpy.ndarray:
+    # difference of every inner value from the value interpolated between first and last at t,
+    # as the largest difference of any component, all arrays have a row per value
+    if kind == STEP:
+        # patterns hold their value, so a keyframe can only go if nothing changes
+        same = numpy.all(inner == first, axis=1) & numpy.all(last == first, axis=1)
+        return numpy.where(same, 0.0, numpy.inf)
+
+    if kind == SLERP:
+        expected = quaternion.slerp(first, last, t)
+        # q and -q are the same rotation
+        return numpy.minimum(numpy.abs(expected - inner).max(1), numpy.abs(expected + inner).max(1))
+
+    expected = first + t[:, None] * (last - first)
+    return numpy.abs(expected - inner).max(1)
+
+
+def span_error(kind: int, values: numpy.ndarray, keyframes: numpy.ndarray, start: int, end: int) -> numpy.ndarray:
+    # error of every keyframe strictly between start and end
+    count = end - start - 1
+    if count < 1:
+        return numpy.zeros(0)
+    # keyframes are uint16 in the file, so the differences are taken in int64
+    t = (keyframes[start + 1:end] - keyframes[start]) / \
+        (keyframes[end] - keyframes[start])
+    return interpolation_error(kind, numpy.repeat(values[start:start + 1], count, 0),
+                               numpy.repeat(values[end:end + 1], count, 0), values[start + 1:end], t)
+
+
+def removed_error(kind: int, values: numpy.ndarray, keyframes: numpy.ndarray, keep: List[int]) -> float:
+    # largest error of the removed keyframes, each between the kept ones around it
+    keep = numpy.array(keep)
+    removed = numpy.setdiff1d(numpy.arange(len(keyframes)), keep)
+    if not len(removed):
+        return 0.0
+    after = keep[numpy.searchsorted(keep, removed)]
+    before = keep[numpy.searchsorted(keep, removed) - 1]
+    t = (keyframes[removed] - keyframes[before]) / \
+        (keyframes[after] - keyframes[before])
+    return float(interpolation_error(kind, values[before], values[after], values[removed], t).max())
+
+
+def neighbour_errors(kind: int, values: numpy.ndarray, keyframes: numpy.ndarray) -> numpy.ndarray:
+    # error of every keyframe but the first and last, between its two neighbours
+    t = (keyframes[1:-1] - keyframes[:-2]) / (keyframes[2:] - keyframes[:-2])
+    return interpolation_error(kind, values[:-2], values[2:], values[1:-1], t)
+
+
+def lossless_keyframes(arrays: List[numpy.ndarray]) -> List[int]:
+    # keeps the first and last keyframe of every run of identical values
+    count = len(arrays[0])
+    inside = numpy.ones(count - 2, dtype=bool)
+    for values in arrays:
+        inside &= numpy.all(values[1:-1] == values[:-2], axis=1) & numpy.all(
+            values[1:-1] == values[2:], axis=1)
+    return [0] + (numpy.flatnonzero(~inside) + 1).tolist() + [count - 1]
+
+
+def reduced_keyframes(kinds: List[int], arrays: List[numpy.ndarray], keyframes: numpy.ndarray, tolerance: float) -> List[int]:
+    # greedily extends every span as far as all curves stay within the tolerance
+    count = len(keyframes)
+
+    def fits(start, end):
+        return all(span_error(k, v, keyframes, start, end).max(initial=0.0) <= tolerance
+                   for k, v in zip(kinds, arrays))
+
+    # whether each keyframe can go between its neighbours, checked for all of them at once
+    # so noisy curves do not pay for a span search at every keyframe
+    removable = numpy.ones(count - 2, dtype=bool)
+    for k, v in zip(kinds, arrays):
+        removable &= neighbour_errors(k, v, keyframes) <= tolerance
+
+    keep = [0]
+    start = 0
+    while start < count - 1:
+        if start + 1 < count - 1 and not removable[start]:
+            keep.append(start + 1)
+            start += 1
+            continue
+        # gallop to a span that does not fit, then search back for the longest one that does
+        good = start + 1
+        step = 1
+        bad = None
+        while good + step < count:
+            if fits(start, good + step):
+                good += step
+                step *= 2
+            else:
+                bad = good + step
+                break
+        if bad is None:
+            bad = count
+        while bad - good > 1:
+            middle = (good + bad) // 2
+            if fits(start, middle):
+                good = middle
+            else:
+                bad = middle
+        keep.append(good)
+        start = good
+    return keep
+
+
+def data_size(curve: Curve, keyframes: int) -> int:
+    format, count = data_format(curve.curve_format)
+    return struct.calcsize(format) * count * keyframes
+
+
+def reduce_file(gmt: GMTFile, tolerance: float) -> List[CurveReduction]:
+    # removes keyframes that interpolating their neighbours reproduces within tolerance
+    # a tolerance of 0 only removes keyframes inside runs of identical values
+    # curves that share a graph are reduced together, and keep sharing the new graph
+    if tolerance < 0:
+        raise ValueError(
+            f"keyframe reduction tolerance cannot be negative: {tolerance}")
+    groups = {}
+    order = {}
+    for a in gmt.animations:
+        for b in a.bones:
+            for c in b.curves:
+                if id(c) not in order:
+                    order[id(c)] = c
+                    groups.setdefault(id(c.graph), []).append((b, c))
+
+    # reported in the order of the curves, not of their graphs
+    reductions = {}
+    for curves in groups.values():
+        graph = curves[0][1].graph
+        keyframes = numpy.array(graph.keyframes, dtype=numpy.int64)
+        count = len(keyframes)
+
+        kinds = [interpolation(c) for _, c in curves]
+        reducible = count > 2 and numpy.all(numpy.diff(keyframes) > 0) \
+            and all(len(c.values) == count for _, c in curves)
+
+        keep = list(range(count))
+        errors = [0.0] * len(curves)
+        if reducible and tolerance > 0:
+            arrays = [curve_array(c, k) for (_, c), k in zip(curves, kinds)]
+            keep = reduced_keyframes(kinds, arrays, keyframes, tolerance)
+            errors = [removed_error(k, v, keyframes, keep)
+                      for k, v in zip(kinds, arrays)]
+        elif reducible:
+            # identical values are reproduced exactly, so there is no error to report
+            keep = lossless_keyframes([curve_array(c) for _, c in curves])
+
+        if len(keep) < count:
+            new_graph = graph.retime([graph.keyframes[i] for i in keep])
+            for _, c in curves:
+                values = c.values
+                c.values = [values[i] for i in keep]
+                c.graph = new_graph
+
+        for (b, c), error in zip(curves, errors):
+            reductions[id(c)] = CurveReduction(b.name.string(), c.curve_format.name, count, len(keep),
+                                               data_size(c, count), data_size(c, len(keep)), error)
+
+    # the graph tables are rebuilt on the next update
+    gmt.mark_changed()
+
+    return [reductions[i] for i in order]
+
+
+def format_reductions(reductions: List[CurveReduction], per_curve=False) -> List[str]:
+    lines = []
+    if per_curve:
+        lines = [f"{r.bone:<24} {r.curve_format:<20} {r.before:6} -> {r.after:6} keyframes {r.size_before:8} -> {r.size_after:8} bytes  max error {r.max_error:.6g}"
+                 for r in reductions]
+    before = sum(r.before for r in reductions)
+    after = sum(r.after for r in reductions)
+    size_before = sum(r.size_before for r in reductions)
+    size_after = sum(r.size_after for r in reductions)
+    max_error = max((r.max_error for r in reductions), default=0.0)
+    lines.append(f"keyframe reduction: {before} -> {after} keyframes in {len(reductions)} curves, "
+                 f"{size_before} -> {size_after} bytes, max error {max_error:.6g}")
+    return lines
@@ -0,0 +1,230 @@
+from collections import OrderedDict
+from typing import List, Tuple
+
+from structure.bone import Bone
+from structure.curve import Curve
+from structure.name import Name
+from structure.types.format import CurveFormat
+from util import position
+from util.read_gmd import (GMDBone, find_gmd_bone, gmd_key, load_cached,
+                           read_gmd_bones, save_cached)
+
+
+# plan operations
+POS_OFFSET = 0  # (POS_OFFSET, bone index, delta, delta)
+LIP_SIDE = 1  # (LIP_SIDE, bone name, bottom lip bone index, delta, delta)
+
+
+class RetargetPlan:
+    # everything transform_bones does to an animation, with the skeleton lookups already done
+    # a plan only depends on the GMDs, the options and the names of the animation's bones
+    def __init__(self):
+        self.ops = []
+
+    ops: List[Tuple]
+
+
+# compiled plans, least recently used are evicted first
+PLAN_CACHE = OrderedDict()
+PLAN_CACHE_SIZE = 64
+
+
+def bone_signature(anm_bones: List[Bone]) -> Tuple[Tuple[str, bool]]:
+    return tuple((b.name.string(), bool(len(b.position_curves()))) for b in anm_bones)
+
+
+def props_key(props) -> Tuple:
+    return (props.version, props.new_bones, props.is_dragon_engine)
+
+
+def retarget_plan(anm_bones: List[Bone], src_props, dst_props, translation) -> RetargetPlan:
+    signature = bone_signature(anm_bones)
+    key = ('retarget', gmd_key(translation.sourcegmd), gmd_key(translation.targetgmd),
+           translation.reparent, translation.face, translation.hand, translation.body,
+           props_key(src_props), props_key(dst_props), signature)
+
+    plan = PLAN_CACHE.get(key)
+    if plan is None:
+        plan = load_cached(key)
+        if plan is None:
+            plan = compile_plan(signature, read_gmd_bones(translation.sourcegmd),
+                                read_gmd_bones(translation.targetgmd), src_props, dst_props, translation)
+            save_cached(key, plan)
+
+        PLAN_CACHE[key] = plan
+        if len(PLAN_CACHE) > PLAN_CACHE_SIZE:
+            PLAN_CACHE.popitem(last=False)
+    else:
+        PLAN_CACHE.move_to_end(key)
+
+    return plan
+
+
+def compile_plan(signature, source_gmd: List[GMDBone], target_gmd: List[GMDBone], src_props, dst_props, translation) -> RetargetPlan:
+    plan = RetargetPlan()
+
+    # lookups always return the first bone with a name, like the list scans they replace
+    names = [n for n, _ in signature]
+    has_pos = [p for _, p in signature]
+    anm_indices = {}
+    for i, n in enumerate(names):
+        anm_indices.setdefault(n, i)
+
+    source_bones = {}
+    for b in source_gmd:
+        source_bones.setdefault(b.name, b)
+    target_bones = {}
+    for b in target_gmd:
+        target_bones.setdefault(b.name, b)
+
+    # TODO: now loop over all bones to check for their children
+    # if you find a common child (after the gmt rename, be sure to update the names),
+    # reparent its positions and rotations like you did with ketu and kosi
+    # then accordingly, reparent its children too etc
+
+    if translation.reparent:
+        for bone_t in target_gmd:
+            bone_s = source_bones.get(bone_t.name)
+            gmt_index = anm_indices.get(bone_t.name)
+
+            if gmt_index is None:
+                continue
+
+            parent_s = bone_s.parent_recursive if bone_s else []
+            parent_t = bone_t.parent_recursive
+            parent_s = parent_s[0] if len(parent_s) else GMDBone()
+            parent_t = parent_t[0] if len(parent_t) else GMDBone()
+
+            parent_new = source_bones.get(parent_t.name, parent_t)
+
+            if bone_s:
+                bone_s.parent_recursive.insert(0, parent_new)
+            else:
+                bone_s = GMDBone()
+
+            # positions
+            if has_pos[gmt_index]:
+                s_pos = tuple(
+                    map(lambda x, y: x - y, parent_s.global_pos, bone_s.global_pos))
+                s_pos_new = tuple(
+                    map(lambda x, y: -x + y, parent_new.global_pos, bone_s.global_pos))
+                plan.ops.append((POS_OFFSET, gmt_index, s_pos, s_pos_new))
+
+    # FIXME: translation doesn't work correctly after reparenting
+    # possible fix: source_gmd should get updated with other fixes
+
+    # more correct fix: it should be updated with predicted bone position, not parent_t
+    def translate(start: str, stop=[]):
+        start_s = [b for b in source_gmd if start in b.name]
+
+        if not len(start_s):
+            return
+
+        stop_children = []
+        if len(stop):
+            for st in stop:
+                stop_s = [b for b in source_gmd if st in b.name]
+                if len(stop_s):
+                    stop_s = stop_s[0]
+                    stop_s.get_children_recursive()
+                    stop_children.extend(
+                        list(map(lambda b: b.name, stop_s.children_recursive)))
+
+        start_s = start_s[0]
+        start_s.get_children_recursive()
+
+        for b_s in start_s.children_recursive:
+            if b_s.name in stop_children:
+                continue
+            b_t = target_bones.get(b_s.name)
+            if not b_t:
+                continue
+
+            p_s = b_s.parent_recursive
+            p_t = b_t.parent_recursive
+            p_s = p_s[0] if len(p_s) else GMDBone()
+            p_t = p_t[0] if len(p_t) else GMDBone()
+
+            if find_gmd_bone(p_s.name, b_t.parent_recursive)[0]:
+                p_t, _ = find_gmd_bone(p_s.name, b_t.parent_recursive)
+
+            gmt_index = anm_indices.get(b_s.name)
+            if gmt_index is None or not has_pos[gmt_index]:
+                continue
+
+            s_pos = tuple(
+                map(lambda x, y: x - y, p_s.global_pos, b_s.global_pos))
+            t_pos = tuple(
+                map(lambda x, y: -x + y, p_t.global_pos, b_t.global_pos))
+            plan.ops.append((POS_OFFSET, gmt_index, s_pos, t_pos))
+
+        if 'face' in start and src_props < dst_props and dst_props.is_dragon_engine:
+            for side_name in ['_lip_side_r_n', '_lip_side_l_n']:
+                # TODO: we're assuming that these bones do exist
+                side_t, _ = find_gmd_bone(side_name, target_gmd)
+                if not side_t:
+                    continue
+
+                btm_name = '_lip_btm_side1_r_n' if 'r' in side_name else '_lip_btm_side1_l_n'
+                btm_index = next(
+                    (i for i, n in enumerate(names) if btm_name in n), -1)
+                if btm_index == -1:
+                    continue
+                btm_t, _ = find_gmd_bone(btm_name, target_gmd)
+
+                if not has_pos[btm_index]:
+                    continue
+
+                plan.ops.append((LIP_SIDE, side_name, btm_index,
+                                 tuple(-x for x in btm_t.global_pos), side_t.global_pos))
+
+                # later lookups can find the new bone
+                names.append(side_name)
+                has_pos.append(True)
+                anm_indices.setdefault(side_name, len(names) - 1)
+
+    if translation.face:
+        if dst_props.new_bones:
+            translate('face_c_n')
+        else:
+            translate('face')
+
+    if translation.hand:
+        translate('ude3_r_n')
+        translate('ude3_l_n')
+
+    if translation.body:
+        if dst_props.new_bones:
+            translate('center_c_n', ['face_c_n', 'ude3_r_n', 'ude3_l_n'])
+        else:
+            translate('center', ['face', 'ude3_r_n', 'ude3_l_n'])
+
+    return plan
+
+
+def apply_plan(plan: RetargetPlan, anm_bones: List[Bone]) -> List[Bone]:
+    for op in plan.ops:
+        if op[0] == POS_OFFSET:
+            _, index, d1, d2 = op
+            gmt_bone = anm_bones[index]
+
+            pos_curve = gmt_bone.position_curves()[0]
+            pos_curve.neutralize()
+            pos_curve.values = position.offset(pos_curve.values, d1, d2)
+
+            gmt_bone.curves[0] = pos_curve.copy()
+        else:
+            _, side_name, btm_index, d1, d2 = op
+            btm_pos = anm_bones[btm_index].position_curves()[0]
+
+            side_gmt = Bone()
+            side_gmt.name = Name(side_name)
+            side_pos = Curve()
+            side_pos.curve_format = CurveFormat.POS_VEC3
+            side_pos.graph = btm_pos.graph
+            side_pos.values = position.offset(btm_pos.values, d1, d2)
+
+            side_gmt.curves.append(side_pos)
+            anm_bones.append(side_gmt)
+
+    return anm_bones
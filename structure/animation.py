@@ -1,5 +1,7 @@
 from typing import List
 
+from util.binary import Layout
+
 from .name import Name
 from .bone import Bone
 from .graph import Graph, zero_graph
@@ -8,15 +10,30 @@ from .curve import Curve
 
 class Animation:
     def __init__(self):
-        self.bones = []
+        self.__bones = []
         self.graphs = []
         self.curves = []
+        self.changed = True
 
     name: Name
-    bones: List[Bone]
     graphs: List[Graph]
     curves: List[Curve]
 
+    # stages replace the bones list as a whole, which marks the animation as changed
+    # so GMTFile.update only recomputes the tables of changed animations
+    # other changes to its curves need GMTFile.mark_changed
+    __bones: List[Bone]
+    changed: bool
+
+    @property
+    def bones(self) -> List[Bone]:
+        return self.__bones
+
+    @bones.setter
+    def bones(self, bones: List[Bone]):
+        self.__bones = bones
+        self.changed = True
+
     index: int
     index1: int
     index2: int
@@ -32,9 +49,38 @@ class Animation:
     graph_data_size: int
     graph_data_offset: int
 
+    def copy(self):
+        # the lists are new, the bones, curves and graphs in them are shared
+        anm = Animation()
+        vars(anm).update(vars(self))
+        anm.bones = list(self.bones)
+        anm.graphs = list(self.graphs)
+        anm.curves = list(self.curves)
+        return anm
+
     def longest_graph(self):
         g = zero_graph()
         for graph in self.graphs:
             if graph.keyframes[-1] > g.keyframes[-1]:
                 g = graph
         return g
+
+
+ANIMATION_LAYOUT = Layout(
+    (None, '4x'),
+    ('frame_count', 'I'),
+    ('index', 'I'),  # name_index?
+    ('frame_rate', 'f'),
+    ('index1', 'I'),
+    ('index2', 'I'),
+    ('bone_map_start', 'I'),
+    ('bone_map_count', 'I'),
+    ('curve_count', 'I'),
+    ('index3', 'I'),  # graph_index?
+    ('graph_count', 'I'),
+    ('anm_data_size', 'I'),
+    ('anm_data_offset', 'I'),
+    ('graph_data_size', 'I'),
+    ('graph_data_offset', 'I'),
+    (None, '4x'),
+)
@@ -14,6 +14,18 @@ class Bone:
 
     curves: List[Curve]
 
+    def copy(self, deep=False):
+        # the curve list is new, the curves in it are shared
+        # unless deep is set, then the name and curves are copied too
+        bone = Bone()
+        vars(bone).update(vars(self))
+        if deep:
+            bone.name = self.name.copy()
+            bone.curves = [c.copy() for c in self.curves]
+        else:
+            bone.curves = list(self.curves)
+        return bone
+
     def position_curves(self):
         return [c for c in self.curves if 'POS' in c.curve_format.name]
 
@@ -1,24 +1,93 @@
-from typing import List, Any
+from typing import Any, Callable, List
+
+from util import position
+from util.binary import Layout
 
 from .graph import *
 from .types.format import CurveFormat
 
 
+CURVE_LAYOUT = Layout(
+    ('graph_index', 'I'),
+    ('anm_data_offset', 'I'),
+    ('property_fmt', 'I'),
+    ('format', 'I'),
+)
+
+
 class Curve:
     def __init__(self):
-        self.values = []
+        self.__values = []
+        self.__source = None
+        self.__shared = False
 
     curve_format: CurveFormat
-    values: List[Any]
 
+    # assigning graph or values outside a conversion stage is not seen by GMTFile.update,
+    # so the file has to be marked with GMTFile.mark_changed afterwards
     graph: Graph
     anm_data_offset: int
     property_fmt: int
     format: int
 
+    # lazy curves keep a source that decodes the first n values from the file
+    # values are only decoded when they are first accessed
+    __values: List[Any]
+    __source: Callable[[int], List[Any]]
+
+    # copies share their value list until it is handed out through values,
+    # since the list itself can be changed in place after that
+    # the values in it are only ever replaced, never changed in place
+    __shared: bool
+
+    @property
+    def values(self) -> List[Any]:
+        if self.__source:
+            self.__values = self.__source(len(self.graph.keyframes))
+            self.__source = None
+            self.__shared = False
+        elif self.__shared:
+            self.__values = list(self.__values)
+            self.__shared = False
+        return self.__values
+
+    @values.setter
+    def values(self, values: List[Any]):
+        self.__values = values
+        self.__source = None
+        self.__shared = False
+
+    def copy(self):
+        curve = Curve()
+        vars(curve).update(vars(self))
+        self.__shared = curve.__shared = True
+        return curve
+
+    def set_source(self, source: Callable[[int], List[Any]]):
+        self.__source = source
+
+    def first_value(self):
+        # decodes only the first keyframe of a lazy curve
+        if self.__source:
+            return self.__source(1)[0]
+        return self.__values[0]
+
+    def __map_values(self, func):
+        # applies func to every value, without decoding a lazy curve
+        self.__map_all(lambda values: [func(v) for v in values])
+
+    def __map_all(self, func):
+        # same as __map_values, but func takes and returns the whole list of values
+        if self.__source:
+            source = self.__source
+            self.__source = lambda n: func(source(n))
+        else:
+            self.__values = func(self.__values)
+            self.__shared = False
+
     def __horizontal_pos(self):
         if self.curve_format == CurveFormat.POS_VEC3:
-            return [[x[0], 0.0, x[2]] for x in self.values]
+            return position.horizontal(self.values)
         elif self.curve_format == CurveFormat.POS_Y:
             return [[0.0] for x in self.values]
         else:
@@ -26,7 +95,7 @@ class Curve:
 
     def __vertical_pos(self):
         if self.curve_format == CurveFormat.POS_VEC3:
-            return [[0.0, x[1], 0.0] for x in self.values]
+            return position.vertical(self.values)
         elif self.curve_format in [CurveFormat.POS_X, CurveFormat.POS_Z]:
             return [[0.0] for x in self.values]
         else:
@@ -35,21 +104,21 @@ class Curve:
     def __neutralize_pos(self):
         if not self.curve_format == CurveFormat.POS_VEC3:
             if 'X' in self.curve_format.name:
-                self.values = [[v[0], 0.0, 0.0] for v in self.values]
+                self.__map_all(lambda v: position.axis_to_vec3(v, 0))
             elif 'Y' in self.curve_format.name:
-                self.values = [[0.0, v[0], 0.0] for v in self.values]
+                self.__map_all(lambda v: position.axis_to_vec3(v, 1))
             elif 'Z' in self.curve_format.name:
-                self.values = [[0.0, 0.0, v[0]] for v in self.values]
+                self.__map_all(lambda v: position.axis_to_vec3(v, 2))
             self.curve_format = CurveFormat.POS_VEC3
 
     def __neutralize_rot(self):
         if not 'QUAT' in self.curve_format.name:
             if 'X' in self.curve_format.name:
-                self.values = [[v[0], 0.0, 0.0, v[1]] for v in self.values]
+                self.__map_values(lambda v: [v[0], 0.0, 0.0, v[1]])
             elif 'Y' in self.curve_format.name:
-                self.values = [[0.0, v[0], 0.0, v[1]] for v in self.values]
+                self.__map_values(lambda v: [0.0, v[0], 0.0, v[1]])
             elif 'Z' in self.curve_format.name:
-                self.values = [[0.0, 0.0, v[0], v[1]] for v in self.values]
+                self.__map_values(lambda v: [0.0, 0.0, v[0], v[1]])
         self.curve_format = CurveFormat.ROT_QUAT_SCALED if self.curve_format.value[
             2] == 2 else CurveFormat.ROT_QUAT_HALF_FLOAT
 
@@ -62,7 +131,7 @@ class Curve:
     def add_pos(self, pos):
         self.neutralize()
         pos.neutralize()
-        return list(map(lambda v, a: [v[0] + a[0], v[1] + a[1], v[2] + a[2]], self.values, pos.values))
+        return position.add(self.values, pos.values)
 
     def to_horizontal(self):
         new_curve = self
@@ -76,21 +145,14 @@ class Curve:
 
 
 def add_curve(curve1, curve2):
-    new_values = []
     if len(curve1.values) > len(curve2.values):
-        for f in curve1.graph.keyframes:
-            kf = f
-            if kf not in curve2.graph.keyframes:
-                kf = [k for k in curve2.graph.keyframes if k < kf][-1]
-            new_values.append(curve2.values[curve2.graph.keyframes.index(kf)])
-        curve2.values = new_values
+        values = curve2.values
+        curve2.values = [values[i] for i in align_keyframes(
+            curve1.graph.keyframes, curve2.graph.keyframes)]
     else:
-        for f in curve2.graph.keyframes:
-            kf = f
-            if kf not in curve1.graph.keyframes:
-                kf = [k for k in curve1.graph.keyframes if k < kf][-1]
-            new_values.append(curve1.values[curve1.graph.keyframes.index(kf)])
-        curve1.values = new_values
+        values = curve1.values
+        curve1.values = [values[i] for i in align_keyframes(
+            curve2.graph.keyframes, curve1.graph.keyframes)]
         curve1.graph = curve2.graph
     curve1.values = curve1.add_pos(curve2)
     return curve1
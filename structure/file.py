@@ -5,12 +5,12 @@ from .name import Name
 from .animation import Animation
 from .bone import Bone
 from .curve import Curve
-from .graph import Graph
+from .graph import Graph, unique_graphs
 
 
 class GMTFile:
     def __init__(self):
-        pass
+        self.__updated = None
 
     header: GMTHeader
     names: List[Name]
@@ -20,8 +20,13 @@ class GMTFile:
     graphs: List[Graph]
     curves: List[Curve]
 
+    # the animations the file tables were last built from
+    __updated: List[Animation]
+
     def __update_animations(self):
         for a in self.animations:
+            if not a.changed:
+                continue
             a.bone_map_count = len(a.bones)
 
             a.curves = []
@@ -29,10 +34,7 @@ class GMTFile:
                 a.curves.extend(b.curves)
             a.curve_count = len(a.curves)
 
-            a.graphs = []
-            for c in a.curves:
-                if c.graph.keyframes not in [g.keyframes for g in a.graphs]:
-                    a.graphs.append(c.graph)
+            a.graphs = unique_graphs(c.graph for c in a.curves)
             a.graph_count = len(a.graphs)
 
             # Turned out to be last frame, not frame count
@@ -40,6 +42,7 @@ class GMTFile:
             for g in a.graphs:
                 frame_count = max(frame_count, g.keyframes[-1])
             a.frame_count = frame_count
+            a.changed = False
 
     def __update_bones(self):
         self.bones = []
@@ -52,10 +55,9 @@ class GMTFile:
             self.curves.extend(b.curves)
 
     def __update_graphs(self):
-        self.graphs = []
-        for c in self.curves:
-            if c.graph.keyframes not in [g.keyframes for g in self.graphs]:
-                self.graphs.append(c.graph)
+        # same as deduping the graphs of every curve, since each animation's are already deduped
+        self.graphs = unique_graphs(
+            g for a in self.animations for g in a.graphs)
 
     def __update_names(self):
         self.names = [a.name for a in self.animations]
@@ -69,34 +71,106 @@ class GMTFile:
         self.header.curve_count = len(self.curves)
         self.header.graph_count = len(self.graphs)
 
+    def mark_changed(self):
+        # for changes update cannot see, like a curve's graph or values replaced in place
+        for a in self.animations:
+            a.changed = True
+
     def update(self):
+        # the file tables are only rebuilt when an animation changed or was added or removed
+        changed = any(a.changed for a in self.animations)
         self.__update_animations()
-        self.__update_bones()
-        self.__update_curves()
-        self.__update_graphs()
-        self.__update_names()
+        if changed or self.__updated != self.animations:
+            self.__update_bones()
+            self.__update_curves()
+            self.__update_graphs()
+            self.__update_names()
+            self.__updated = list(self.animations)
         self.__update_header()
 
-    def merge(self, other):
-        anm_s = self.animations[0]
-        anm_o = other.animations[0]
-        bones = []
+    def clone(self):
+        # a copy that can be converted without changing this file
+        # objects shared by several animations or bones stay shared in the clone
+        # graphs are immutable, so they are not copied
+        copies = {}
+
+        def copy_of(obj):
+            c = copies.get(id(obj))
+            if c is None:
+                c = copies[id(obj)] = obj.copy()
+            return c
+
+        def bone_copy(b):
+            bone = copies.get(id(b))
+            if bone is None:
+                bone = copies[id(b)] = b.copy()
+                bone.name = copy_of(b.name)
+                bone.curves = [copy_of(c) for c in b.curves]
+            return bone
+
+        file = GMTFile()
+        file.header = self.header.copy()
+        file.names = [copy_of(n) for n in self.names]
+        file.graphs = list(self.graphs)
+        file.curves = [copy_of(c) for c in self.curves]
+        file.bones = [bone_copy(b) for b in self.bones]
+
+        file.animations = []
+        for a in self.animations:
+            anm = a.copy()
+            anm.name = copy_of(a.name)
+            anm.bones = [bone_copy(b) for b in a.bones]
+            anm.curves = [copy_of(c) for c in a.curves]
+            file.animations.append(anm)
+
+        return file
 
-        if anm_s.longest_graph().keyframes[-1] + anm_o.longest_graph().keyframes[-1] > 65_535:
-            return -1
+    def merge(self, other):
+        return 0 if self.merge_all([other]) else -1
 
-        for b_s, b_o in zip(anm_s.bones, anm_o.bones):
-            curves = []
-            for c_s, c_o in zip(b_s.curves, b_o.curves):
+    def merge_all(self, others) -> int:
+        # appends the first animation of each file in others to this file's first animation,
+        # in order, until one would go past the last frame a graph can hold
+        # returns how many files were merged
+        # every curve is concatenated once at the end, however many files are merged
+        anm_s = self.animations[0]
+        last_frame = anm_s.longest_graph().keyframes[-1]
+
+        # (bone, [[curve, ends with keyframe, [(appended curve, keyframe shift)]]])
+        bones = [(b, [[c, c.graph.keyframes[-1], []] for c in b.curves])
+                 for b in anm_s.bones]
+
+        merged = 0
+        for other in others:
+            anm_o = other.animations[0]
+            if last_frame + anm_o.longest_graph().keyframes[-1] > 65_535:
+                break
+
+            # bones and curves that are missing in other are dropped
+            bones = [(b_s, curves[:len(b_o.curves)])
+                     for (b_s, curves), b_o in zip(bones, anm_o.bones)]
+            last_frame = 0
+            for (_, curves), b_o in zip(bones, anm_o.bones):
+                for parts, c_o in zip(curves, b_o.curves):
+                    parts[2].append((c_o, parts[1] + 1))
+                    parts[1] += 1 + c_o.graph.keyframes[-1]
+                    last_frame = max(last_frame, parts[1])
+            merged += 1
+
+        if not merged:
+            return 0
+
+        for b_s, curves in bones:
+            for c_s, _, appended in curves:
                 c_s.neutralize()
-                c_o.neutralize()
-                o_frames = list(
-                    map(lambda x: x + c_s.graph.keyframes[-1] + 1, c_o.graph.keyframes))
-                c_s.values.extend(c_o.values)
-                c_s.graph.keyframes.extend(o_frames)
-                curves.append(c_s)
-            b_s.curves = curves
-            bones.append(b_s)
-        self.animations[0].bones = bones
+                values = c_s.values
+                keyframes = list(c_s.graph.keyframes)
+                for c_o, shift in appended:
+                    c_o.neutralize()
+                    values.extend(c_o.values)
+                    keyframes.extend(k + shift for k in c_o.graph.keyframes)
+                c_s.graph = c_s.graph.retime(keyframes)
+            b_s.curves = [c for c, _, _ in curves]
+        anm_s.bones = [b for b, _ in bones]
         self.update()
-        return 0
+        return merged
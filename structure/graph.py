@@ -1,16 +1,62 @@
-from typing import List
+from bisect import bisect_left, bisect_right
+from typing import Dict, Iterable, List, Sequence, Tuple
 
 
 class Graph:
-    def __init__(self):
-        self.keyframes = []
+    # graphs are shared between curves and between animations, so they are
+    # never modified: stages that retime a curve assign it a new graph
+    def __init__(self, keyframes: Sequence[int] = (), delimiter: int = -1):
+        self.__keyframes = tuple(keyframes)
+        self.__delimiter = delimiter
 
-    keyframes = List[int]
-    delimiter = int  # either FF or 0
+    __keyframes: Tuple[int, ...]
+    __delimiter: int  # either FF or 0
+
+    @property
+    def keyframes(self) -> Tuple[int, ...]:
+        return self.__keyframes
+
+    @property
+    def delimiter(self) -> int:
+        return self.__delimiter
+
+    def retime(self, keyframes: Sequence[int]):
+        return Graph(keyframes, self.__delimiter)
 
 
 def zero_graph():
-    zero = Graph()
-    zero.keyframes = [0]
-    zero.delimiter = -1
-    return zero
+    return Graph((0,), -1)
+
+
+def graph_index(graphs: Iterable[Graph]) -> Dict[Tuple[int, ...], int]:
+    # position of the first graph with each keyframe sequence
+    index = {}
+    for i, g in enumerate(graphs):
+        index.setdefault(g.keyframes, i)
+    return index
+
+
+def unique_graphs(graphs: Iterable[Graph]) -> List[Graph]:
+    # the first graph with each keyframe sequence, in order
+    # graphs are mostly shared, so each one's keyframes are only hashed once
+    unique = {}
+    seen = set()
+    for g in graphs:
+        if id(g) not in seen:
+            seen.add(id(g))
+            unique.setdefault(g.keyframes, g)
+    return list(unique.values())
+
+
+def align_keyframes(keyframes: Sequence[int], other: Sequence[int]) -> List[int]:
+    # index of the value in other to use at each keyframe:
+    # the same keyframe, or else the last one before it
+    # other has to be sorted, like every graph read from a file
+    indices = []
+    for kf in keyframes:
+        i = bisect_right(other, kf) - 1
+        if i < 0:
+            raise IndexError(f"no keyframe at or before {kf}")
+        # repeated keyframes resolve to the first one
+        indices.append(bisect_left(other, other[i]))
+    return indices
@@ -1,3 +1,5 @@
+from util.binary import Layout
+
 from .name import Name
 
 
@@ -28,3 +30,36 @@ class GMTHeader:
     anm_data_offset: int
 
     flags: int
+
+    def copy(self):
+        header = GMTHeader()
+        vars(header).update(vars(self))
+        header.file_name = self.file_name.copy()
+        return header
+
+
+# everything after the magic and the endianness bytes (0x08 - 0x80)
+HEADER_LAYOUT = Layout(
+    ('version', 'I'),
+    ('data_size', 'I'),
+    ('file_name_checksum', 'H'),
+    ('file_name', '30s'),
+    ('anm_count', 'I'),
+    ('anm_offset', 'I'),
+    ('graph_count', 'I'),
+    ('graph_offset', 'I'),
+    ('graph_data_size', 'I'),
+    ('graph_data_offset', 'I'),
+    ('name_count', 'I'),
+    ('name_offset', 'I'),
+    ('anm_map_count', 'I'),
+    ('anm_map_offset', 'I'),
+    ('bone_map_count', 'I'),
+    ('bone_map_offset', 'I'),
+    ('curve_count', 'I'),
+    ('curve_offset', 'I'),
+    ('anm_data_size', 'I'),
+    ('anm_data_offset', 'I'),
+    (None, '12x'),
+    ('flags', 'I'),
+)
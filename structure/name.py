@@ -10,6 +10,9 @@ class Name:
         self.__string = new_string
         self.__checksum = sum(new_string.encode('shift-jis'))
 
+    def copy(self):
+        return Name(self.__string)
+
     def checksum(self):
         return self.__checksum
 
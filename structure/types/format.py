@@ -1,7 +1,7 @@
 from typing import Tuple
 from enum import Enum
 
-from pyquaternion import Quaternion
+import numpy
 
 
 class CurveFormat(Enum):
@@ -127,12 +127,15 @@ def pack_curve_format(curve_format: CurveFormat) -> Tuple[int, int]:
     return (curve_format.value[0], format_major + format_minor)
 
 
-def curve_array_to_quat(format: CurveFormat, value) -> Quaternion:
-    if 'XW' in format.name:
-        return Quaternion(value[1], value[0], 0, 0)
-    elif 'YW' in format.name:
-        return Quaternion(value[1], 0, value[0], 0)
-    elif 'ZW' in format.name:
-        return Quaternion(value[1], 0, 0, value[0])
-    else:
-        return Quaternion(value[3], value[0], value[1], value[2])
+def curve_values_to_quats(format: CurveFormat, values) -> numpy.ndarray:
+    # single axis rotations (XW, YW, ZW) as full quaternions, as (N, 4) rows of (x, y, z, w)
+    if not len(values):
+        return numpy.zeros((0, 4))
+    values = numpy.array(values, dtype=float)
+    if 'XW' in format.name or 'YW' in format.name or 'ZW' in format.name:
+        axis = 0 if 'XW' in format.name else 1 if 'YW' in format.name else 2
+        quats = numpy.zeros((len(values), 4))
+        quats[:, axis] = values[:, 0]
+        quats[:, 3] = values[:, 1]
+        return quats
+    return values[:, :4]
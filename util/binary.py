@@ -1,22 +1,119 @@
 
 import struct
+from collections import OrderedDict
+from contextlib import contextmanager
 from itertools import chain
-
-from multi_key_dict import multi_key_dict
-
-
-FMT = multi_key_dict()
-FMT["i", "I", "f"] = 4
-FMT["h", "H", "e"] = 2
-FMT["b", "B", "s"] = 1
+from mmap import mmap, ACCESS_READ, ACCESS_WRITE
+from os import fstat
+from os.path import realpath
+from typing import Any, Dict, List, Union
+
+import numpy
+
+
+# compiled struct codecs, keyed by (big_endian, format, count)
+# counts vary with every graph and curve length, so least recently used are evicted first
+CODECS = OrderedDict()
+CODECS_SIZE = 256
+
+
+def codec(big_end: bool, format: str, count: int) -> struct.Struct:
+    key = (big_end, format, count)
+    c = CODECS.get(key)
+    if c is None:
+        c = CODECS[key] = struct.Struct(
+            (">" if big_end else "<") + str(count) + format)
+        if len(CODECS) > CODECS_SIZE:
+            CODECS.popitem(last=False)
+    else:
+        CODECS.move_to_end(key)
+    return c
+
+
+class Layout:
+    # a fixed size record, read or written with a single struct call
+    # fields are (name, format) pairs, where the format is a struct format
+    # with an optional count ('I', '30s', '4f', '12x')
+    # fields with no name are padding and must use 'x'
+    # multi-value fields are read as tuples and strings are decoded as shift-jis
+
+    def __init__(self, *fields):
+        self.fields = []
+        for name, format in fields:
+            type = format[-1]
+            count = int(format[:-1] or 1)
+            self.fields.append(
+                (name, 0 if type == 'x' else 1 if type == 's' else count))
+
+        format = "".join([f for _, f in fields])
+        self.__codecs = (struct.Struct("<" + format),
+                         struct.Struct(">" + format))
+        self.size = self.__codecs[0].size
+
+    def codec(self, big_end: bool) -> struct.Struct:
+        return self.__codecs[big_end]
+
+    def unpack(self, values) -> Dict[str, Any]:
+        record = {}
+        i = 0
+        for name, count in self.fields:
+            if count == 1:
+                value = values[i]
+                if type(value) is bytes:
+                    value = value.split(b'\x00', 1)[0].decode('shift-jis')
+                record[name] = value
+            elif count:
+                record[name] = values[i:i + count]
+            i += count
+        return record
+
+    def pack(self, record: Dict[str, Any]) -> List[Any]:
+        values = []
+        for name, count in self.fields:
+            if count == 1:
+                value = record[name]
+                if type(value) is str:
+                    value = value.encode('shift-jis')
+                values.append(value)
+            elif count:
+                values.extend(record[name])
+        return values
+
+
+# read only sources (bytes, mmap, memoryview) can be parsed without copying
+Buffer = Union[bytearray, bytes, mmap, memoryview]
+
+
+@contextmanager
+def map_file(path: str):
+    # maps the file read-only for the duration of the with block
+    # anything parsed from it has to be copied out before the block ends
+    with open(realpath(path), "rb") as f:
+        if not fstat(f.fileno()).st_size:
+            # empty files cannot be mapped
+            yield b''
+            return
+        with mmap(f.fileno(), 0, access=ACCESS_READ) as buf:
+            yield buf
+
+
+@contextmanager
+def map_output(path: str, size: int):
+    # creates (or truncates) the file at the final size and maps it for writing
+    # sections can be packed straight into the file at their planned offsets
+    with open(realpath(path), "w+b") as f:
+        f.truncate(size)
+        with mmap(f.fileno(), size, access=ACCESS_WRITE) as buf:
+            yield buf
+            buf.flush()
 
 
 class BinaryReader:
-    __buf: bytearray
+    __buf: Buffer
     __idx: int
     __big_end: bool
 
-    def __init__(self, buffer: bytearray):
+    def __init__(self, buffer: Buffer):
         self.__buf = buffer
         self.__idx = 0
         self.__big_end = True
@@ -33,7 +130,7 @@ class BinaryReader:
     def align(self, size):
         if self.__idx % size:
             pad = size - (self.__idx % size)
-            self.__buf.extend([0 for x in range(pad)])
+            self.__buf.extend(bytes(pad))
             return pad
         return 0
 
@@ -57,12 +154,26 @@ class BinaryReader:
         self.__big_end = is_big_endian
 
     def __read_type(self, format: str, count: int):
+        c = codec(self.__big_end, format, count)
+
         i = self.__idx
-        self.__idx += FMT[format] * count
+        self.__idx += c.size
+
+        return c.unpack_from(self.__buf, i)
+
+    def read_array(self, format: str, count=1) -> numpy.ndarray:
+        i = self.__idx
+        self.__idx += numpy.dtype(format).itemsize * count
 
         end = ">" if self.__big_end else "<"
 
-        return struct.unpack_from(end + str(count) + format, self.__buf, i)
+        return numpy.frombuffer(self.__buf, end + format, count, i)
+
+    def read_record(self, layout: Layout) -> Dict[str, Any]:
+        i = self.__idx
+        self.__idx += layout.size
+
+        return layout.unpack(layout.codec(self.__big_end).unpack_from(self.__buf, i))
 
     def read_str(self, length=1):
         return self.__read_type("s", length)[0].split(b'\x00', 1)[0].decode('shift-jis')
@@ -107,33 +218,40 @@ class BinaryReader:
             return self.__read_type("e", count)
         return self.__read_type("e", count)[0]
 
+    def __reserve(self, end: int):
+        # grows the buffer only when writing past its end
+        if end > len(self.__buf):
+            self.__buf.extend(bytes(end - len(self.__buf)))
+
     def __write_type(self, format: str, value, count, is_iterable):
         i = self.__idx
 
-        end = ">" if self.__big_end else "<"
-
         if is_iterable:
             if count == -1:
                 count = 1
             count *= len(value)
-            if i + (FMT[format] * count) > self.size():
-                self.__buf.extend([0 for x in range(FMT[format] * count)])
-            struct.pack_into(end + str(count) + format,
-                             self.__buf, i, *list(chain(*value)))
+            value = list(chain(*value))
         elif count == -1 or type(value) is bytes:
             if count == -1:
                 count = 1
-            if i + (FMT[format] * count) > self.size():
-                self.__buf.extend([0 for x in range(FMT[format] * count)])
-            struct.pack_into(end + str(count) + format, self.__buf, i, value)
-        else:
-            if count == -1:
-                count = 1
-            if i + (FMT[format] * count) > self.size():
-                self.__buf.extend([0 for x in range(FMT[format] * count)])
-            struct.pack_into(end + str(count) + format, self.__buf, i, *value)
+            value = [value]
+
+        c = codec(self.__big_end, format, count)
+        self.__reserve(i + c.size)
+        c.pack_into(self.__buf, i, *value)
+
+        self.__idx += c.size
+
+        return self.__idx - i
+
+    def write_record(self, layout: Layout, record: Dict[str, Any]):
+        i = self.__idx
 
-        self.__idx += FMT[format] * count
+        c = layout.codec(self.__big_end)
+        self.__reserve(i + c.size)
+        c.pack_into(self.__buf, i, *layout.pack(record))
+
+        self.__idx += c.size
 
         return self.__idx - i
 
@@ -163,3 +281,13 @@ class BinaryReader:
 
     def write_half_float(self, value, count=-1, is_iterable=False):
         return self.__write_type("e", value, count, is_iterable)
+
+    def write_bytes(self, data: bytes):
+        i = self.__idx
+
+        self.__reserve(i + len(data))
+        self.__buf[i:i + len(data)] = data
+
+        self.__idx += len(data)
+
+        return self.__idx - i
@@ -0,0 +1,52 @@
+from typing import Any, List
+
+import numpy
+
+
+# kernels for whole position curves, taking value lists and returning (N, 3) lists
+# sums are done in the same order as the per-keyframe code they replace,
+# so the results are identical
+
+
+def as_array(values: List[Any], width=3) -> numpy.ndarray:
+    # narrower values would broadcast instead of failing like indexing them does
+    if not len(values):
+        return numpy.zeros((0, width))
+    array = numpy.array(values, dtype=float)
+    if array.ndim != 2 or array.shape[1] < width:
+        raise IndexError(
+            f"position values of shape {array.shape} do not have {width} components")
+    return array[:, :width]
+
+
+def offset(values: List[Any], *deltas) -> List[List[float]]:
+    # adds the deltas to every (x, y, z) value, in the same order as v[i] + d1[i] + d2[i]
+    array = as_array(values)
+    for d in deltas:
+        array = array + as_array([d])[0]
+    return array.tolist()
+
+
+def horizontal(values: List[Any]) -> List[List[float]]:
+    array = as_array(values)
+    array[:, 1] = 0.0
+    return array.tolist()
+
+
+def vertical(values: List[Any]) -> List[List[float]]:
+    array = as_array(values)
+    array[:, [0, 2]] = 0.0
+    return array.tolist()
+
+
+def axis_to_vec3(values: List[Any], axis: int) -> List[List[float]]:
+    # single axis values (POS_X, POS_Y, POS_Z) as full vectors
+    array = numpy.zeros((len(values), 3))
+    array[:, axis] = as_array(values, 1)[:, 0]
+    return array.tolist()
+
+
+def add(values: List[Any], other: List[Any]) -> List[List[float]]:
+    # sums aligned curves, stopping at the end of the shorter one
+    count = min(len(values), len(other))
+    return (as_array(values[:count]) + as_array(other[:count])).tolist()
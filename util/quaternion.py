@@ -0,0 +1,68 @@
+import numpy
+
+
+# batched quaternion math on (N, 4) arrays of (x, y, z, w), the order curves store them in
+# products are taken in (w, x, y, z) order with one matrix product per row,
+# the same way the per-keyframe code did, so results match it bit for bit
+
+
+def wxyz(q: numpy.ndarray) -> numpy.ndarray:
+    return q[:, [3, 0, 1, 2]]
+
+
+def xyzw(q: numpy.ndarray) -> numpy.ndarray:
+    return q[:, [1, 2, 3, 0]]
+
+
+def dot(a: numpy.ndarray, b: numpy.ndarray) -> numpy.ndarray:
+    return numpy.matmul(wxyz(a)[:, None, :], wxyz(b)[:, :, None])[:, 0, 0]
+
+
+def multiply(a: numpy.ndarray, b: numpy.ndarray) -> numpy.ndarray:
+    w, x, y, z = wxyz(a).T
+    matrix = numpy.stack([
+        numpy.stack([w, -x, -y, -z], 1),
+        numpy.stack([x, w, -z, y], 1),
+        numpy.stack([y, z, w, -x], 1),
+        numpy.stack([z, -y, x, w], 1),
+    ], 1)
+    return xyzw(numpy.matmul(matrix, wxyz(b)[:, :, None])[:, :, 0])
+
+
+def inverse(q: numpy.ndarray) -> numpy.ndarray:
+    ss = dot(q, q)
+    if not numpy.all(ss > 0):
+        raise ZeroDivisionError(
+            "a zero quaternion (0 + 0i + 0j + 0k) cannot be inverted")
+    conjugate = numpy.concatenate([-q[:, :3], q[:, 3:]], 1)
+    return conjugate / ss[:, None]
+
+
+def normalize(q: numpy.ndarray) -> numpy.ndarray:
+    # zero quaternions are left as they are
+    n = numpy.sqrt(dot(q, q))[:, None]
+    return numpy.where(n > 0, q / numpy.where(n > 0, n, 1.0), q)
+
+
+def slerp(a: numpy.ndarray, b: numpy.ndarray, amount) -> numpy.ndarray:
+    # amount is a scalar or one value per row, clipped to [0, 1]
+    a = normalize(a)
+    b = normalize(b)
+    amount = numpy.clip(numpy.broadcast_to(
+        numpy.asarray(amount, dtype=float), (len(a),)), 0.0, 1.0)[:, None]
+
+    d = dot(a, b)[:, None]
+    # take the short way around
+    a = numpy.where(d < 0, -a, a)
+    d = numpy.abs(d)
+
+    # nearly parallel quaternions are interpolated linearly
+    linear = d > 0.9995
+    theta_0 = numpy.arccos(numpy.where(linear, 0.0, d))
+    sin_theta_0 = numpy.where(linear, 1.0, numpy.sin(theta_0))
+    theta = theta_0 * amount
+    s0 = numpy.where(linear, 1.0 - amount,
+                     numpy.cos(theta) - d * numpy.sin(theta) / sin_theta_0)
+    s1 = numpy.where(linear, amount, numpy.sin(theta) / sin_theta_0)
+
+    return normalize(s0 * a + s1 * b)
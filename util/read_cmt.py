@@ -1,7 +1,7 @@
 from typing import List
-from os.path import basename, realpath
+from os.path import basename
 
-from .binary import BinaryReader
+from .binary import BinaryReader, map_file
 
 
 class CMTData:
@@ -127,11 +127,12 @@ def read_animation_data(cmt: BinaryReader, count: int, format: int) -> List[CMTD
 
 
 def read_cmt_file(path: str) -> CMTFile:
-    file = CMTFile()
+    with map_file(path) as buffer:
+        return parse_cmt_file(BinaryReader(buffer), path)
+
 
-    f = open(realpath(path), "rb")
-    cmt = BinaryReader(f.read())
-    f.close()
+def parse_cmt_file(cmt: BinaryReader, path: str) -> CMTFile:
+    file = CMTFile()
 
     if cmt.read_str(4) != "CMTP":
         print("Invalid magic")
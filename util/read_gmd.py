@@ -1,8 +1,28 @@
-from typing import List
-from copy import deepcopy
+import hashlib
+import os
+import pickle
+from collections import OrderedDict
 from os.path import realpath
+from typing import List, Tuple
 
-from .binary import BinaryReader
+from .binary import BinaryReader, Layout, map_file
+
+
+GMD_BONE_LAYOUT = Layout(
+    (None, '4x'),
+    ('child', 'i'),
+    ('sibling', 'i'),
+    (None, '12x'),
+    ('name_index', 'i'),
+    (None, '4x'),
+    ('local_pos', '4f'),
+    ('local_rot', '4f'),
+    ('local_scale', '4f'),
+    ('global_pos', '4f'),
+    ('axis', '3f'),
+    ('length', 'f'),
+    (None, '16x'),
+)
 
 
 class GMDBone:
@@ -39,11 +59,90 @@ class GMDBone:
                 re_bones = re_bones_new
 
 
+# parsed skeletons keyed by (path, mtime, size), least recently used are evicted first
+# only the bone records are cached, every call builds new GMDBone objects from them
+# so callers are free to change the bones they get
+GMD_CACHE = OrderedDict()
+GMD_CACHE_SIZE = 16
+
+# optional folder where the records (and anything else keyed by skeletons)
+# are also pickled, to be reused by later runs
+GMD_CACHE_DIR = None
+
+
+def set_gmd_cache_dir(path: str):
+    global GMD_CACHE_DIR
+    if path:
+        os.makedirs(path, exist_ok=True)
+    GMD_CACHE_DIR = path
+
+
+def cache_file(key) -> str:
+    return os.path.join(GMD_CACHE_DIR, hashlib.sha1(repr(key).encode()).hexdigest() + ".pickle")
+
+
+def load_cached(key):
+    if not GMD_CACHE_DIR:
+        return None
+    try:
+        with open(cache_file(key), "rb") as f:
+            cached_key, value = pickle.load(f)
+        if cached_key == key:
+            return value
+    except Exception:
+        pass
+    return None
+
+
+def save_cached(key, value):
+    if not GMD_CACHE_DIR:
+        return
+    try:
+        temp = cache_file(key) + f".{os.getpid()}"
+        with open(temp, "wb") as f:
+            pickle.dump((key, value), f)
+        os.replace(temp, cache_file(key))
+    except OSError:
+        pass
+
+
+def gmd_key(path: str):
+    path = realpath(path)
+    stat = os.stat(path)
+    return (path, stat.st_mtime_ns, stat.st_size)
+
+
 def read_gmd_bones(path: str) -> List[GMDBone]:
-    f = open(realpath(path), "rb")
-    gmd = BinaryReader(f.read())
-    f.close()
+    key = gmd_key(path)
+
+    records = GMD_CACHE.get(key)
+    if records is None:
+        records = load_cached(key)
+        if records is None:
+            with map_file(key[0]) as buffer:
+                records = read_gmd_records(BinaryReader(buffer))
+            if records is None:
+                return
+            save_cached(key, records)
+
+        GMD_CACHE[key] = records
+        if len(GMD_CACHE) > GMD_CACHE_SIZE:
+            GMD_CACHE.popitem(last=False)
+    else:
+        GMD_CACHE.move_to_end(key)
+
+    return build_bones(records)
+
+
+def parse_gmd_bones(gmd: BinaryReader) -> List[GMDBone]:
+    records = read_gmd_records(gmd)
+    if records is None:
+        return
+    return build_bones(records)
+
 
+def read_gmd_records(gmd: BinaryReader) -> List[Tuple]:
+    # (name, child, sibling, local_pos, local_rot, local_scale, global_pos, axis, length) of every bone
     if gmd.read_str(4) != "GSGM":
         print("Invalid GMD magic!")
         return
@@ -61,36 +160,36 @@ def read_gmd_bones(path: str) -> List[GMDBone]:
     gmd.seek(0x80)
     names_offset = gmd.read_uint32()
 
-    bones = []
+    records = []
     for b in range(bone_count):
-        bone = GMDBone()
+        gmd.seek(bone_offset + (GMD_BONE_LAYOUT.size * b))
+
+        record = gmd.read_record(GMD_BONE_LAYOUT)
+
+        gmd.seek(names_offset + (record['name_index'] * 0x20) + 2)
+        name = str(gmd.read_str(30))
 
-        gmd.seek(bone_offset + (0x80 * b))
+        records.append((name, record['child'], record['sibling'],
+                        record['local_pos'], record['local_rot'], record['local_scale'],
+                        record['global_pos'], record['axis'], record['length']))
 
-        gmd.skip(0x4)
-        bone.child = gmd.read_int32()
-        bone.sibling = gmd.read_int32()
-        gmd.skip(0xC)
-        name_index = gmd.read_int32()
+    return records
 
-        gmd.skip(4)
-        bone.local_pos = gmd.read_float(4)
-        bone.local_rot = gmd.read_float(4)
-        bone.local_scale = gmd.read_float(4)
-        bone.global_pos = gmd.read_float(4)
-        bone.axis = gmd.read_float(3)
-        bone.length = gmd.read_float()
 
-        gmd.seek(names_offset + (name_index * 0x20) + 2)
-        bone.name = str(gmd.read_str(30))
+def build_bones(records: List[Tuple]) -> List[GMDBone]:
+    bones = []
+    for record in records:
+        bone = GMDBone()
+        (bone.name, bone.child, bone.sibling,
+         bone.local_pos, bone.local_rot, bone.local_scale,
+         bone.global_pos, bone.axis, bone.length) = record
         bones.append(bone)
 
     return get_children(bones)
 
 
 def get_children(bones):
-    for bone in bones:
-        index = bones.index(bone)
+    for index, bone in enumerate(bones):
         i = bone.child
         while i != -1:
             b = bones[i]
@@ -1,12 +1,11 @@
 from typing import List
 from os.path import basename
 
-from .binary import BinaryReader
+from .binary import BinaryReader, map_output
 from .read_cmt import *
 
 
-def write_animations(cmt: CMTFile):
-    buf = BinaryReader(bytearray())
+def write_animations(cmt: CMTFile, buf: BinaryReader):
     i = 1
     prev_count = 0
     for anm in cmt.animations:
@@ -16,11 +15,9 @@ def write_animations(cmt: CMTFile):
         buf.write_uint32(anm.format)
         prev_count = anm.frame_count
         i += 1
-    return buf.buffer()
 
 
-def write_anm_data(cmt: CMTFile):
-    buf = BinaryReader(bytearray())
+def write_anm_data(cmt: CMTFile, buf: BinaryReader):
     for anm in cmt.animations:
         for data in anm.anm_data:
             buf.write_float(data.pos_x)
@@ -32,37 +29,39 @@ def write_anm_data(cmt: CMTFile):
             buf.write_float(data.foc_y)
             buf.write_float(data.foc_z)
             buf.write_float(data.rot)
-    return buf.buffer()
 
 
-def write_cmt_file(cmt: CMTFile, version: int) -> CMTFile:
-    file = BinaryReader(bytearray())
-
-    anm_data = write_anm_data(cmt)
-
-    animations = write_animations(cmt)
-
+def write_sections(cmt: CMTFile, file: BinaryReader, version: int, file_size: int):
     # write header
     file.write_str("CMTP", length=4)
     file.write_int8(-1)
     file.write_uint8(1)
     file.write_uint16(0)
     file.write_uint32(version)
-    # file_size
-    file.write_uint32(0)
+    file.write_uint32(file_size)
 
     file.write_uint32(cmt.header.anm_count)
     file.write_uint32(cmt.header.unk1)
     file.write_uint32(cmt.header.unk2)
     file.write_uint32(cmt.header.unk3)
 
-    file.extend(animations)
+    write_animations(cmt, file)
 
-    file.extend(anm_data)
+    write_anm_data(cmt, file)
 
-    file.seek(0, from_end=True)
-    file_size = file.pos()
-    file.seek(0xC)
-    file.write_uint32(file_size)
+
+def write_cmt_file(cmt: CMTFile, version: int, path: str = None) -> CMTFile:
+    # returns the file as a bytearray, or writes it straight to path
+    # and returns the number of bytes written
+    file_size = 0x20 + (0x10 * len(cmt.animations)) + \
+        (0x20 * sum([len(anm.anm_data) for anm in cmt.animations]))
+
+    if path:
+        with map_output(path, file_size) as buffer:
+            write_sections(cmt, BinaryReader(buffer), version, file_size)
+        return file_size
+
+    file = BinaryReader(bytearray(file_size))
+    write_sections(cmt, file, version, file_size)
 
     return file.buffer()
@@ -1,266 +1,349 @@
+from itertools import chain
 from typing import List, Tuple
 
-from pyquaternion import Quaternion
+import numpy
 
-from util.binary import BinaryReader
+from util.binary import BinaryReader, map_output
 from structure.types.format import CurveFormat, pack_curve_format
 from structure.file import GMTFile
-from structure.header import GMTHeader
-from structure.animation import Animation
+from structure.header import GMTHeader, HEADER_LAYOUT
+from structure.animation import Animation, ANIMATION_LAYOUT
 from structure.bone import Bone
-from structure.curve import Curve
-from structure.graph import Graph
+from structure.curve import Curve, CURVE_LAYOUT
+from structure.graph import Graph, graph_index
 from structure.name import Name
 
 
-def write_anm_maps(gmt: GMTFile) -> bytearray:
-    anm_maps = BinaryReader(bytearray())
+def align(size: int, alignment: int) -> int:
+    return size + (-size % alignment)
+
+
+class FileLayout:
+    # offsets and sizes of every section, computed before anything is written
+    def __init__(self):
+        pass
+
+    anm_offset: int
+    graph_offsets_offset: int
+    graph_offset: int
+    graph_data_size: int
+    name_offset: int
+    anm_map_offset: int
+    bone_map_offset: int
+    curve_offset: int
+    anm_data_offset: int
+    anm_data_size: int
+    file_size: int
+    buffer_size: int
+
+    g_offsets: List[int]
+    g_sizes: List[int]
+    anm_data_offsets: List[int]
+    anm_data_sizes: List[int]
+    anm_data_blocks: List[bytes]
+    anm_data_saved: int
+
+
+def data_format(curve_format: CurveFormat) -> Tuple[str, int]:
+    # (struct format, values per keyframe) of a curve's animation data
+    if 'POS' in curve_format.name:
+        if 'VEC3' in curve_format.name:
+            return ('f', 3)
+        return ('f', 1)  # 'X', 'Y', 'Z'
+    elif 'ROT' in curve_format.name:
+        if 'QUAT' in curve_format.name:
+            if 'SCALED' in curve_format.name:
+                return ('h', 4)
+            return ('e', 4)  # 'HALF_FLOAT'
+        elif 'W_SCALED' in curve_format.name:
+            return ('h', 2)
+        elif 'W_FLOAT' in curve_format.name:
+            return ('f', 2)
+        return ('e', 2)  # 'W_HALF_FLOAT'
+    elif 'PAT1' in curve_format.name:
+        return ('h', 2)
+    # 'PAT2', also falls for unknown face_c_n patterns
+    return ('b', 1)
+
+
+def plan_graphs(gmt: GMTFile) -> Tuple[List[int], List[int]]:
+    offsets = []
+    sizes = []
+    pos = 0
+    for g in gmt.graphs:
+        offsets.append(pos)
+        # count, keyframes, delimiter
+        size = 2 + (2 * len(g.keyframes)) + 2
+        sizes.append(size)
+        pos += size
+    return offsets, sizes
+
+
+def plan_animation_data(gmt: GMTFile, dedup=False) -> Tuple[List[int], List[int], List[bytes], int]:
+    # every curve's data is encoded here, so identical blocks can be found before writing
+    # with dedup, curves with identical data point at a single copy of it
+    # sizes are the bytes each curve adds to the section, shared copies add none
+    # and have no block of their own
+    offsets = []
+    sizes = []
+    blocks = []
+    written = {}
+    saved = 0
+    pos = 0
+    for c in gmt.curves:
+        if c.curve_format in [CurveFormat.ROT_QUAT_XYZ_FLOAT, CurveFormat.ROT_QUAT_INT_SCALED]:
+            c.curve_format = CurveFormat.ROT_QUAT_SCALED if gmt.header.version > 0x10001 else CurveFormat.ROT_QUAT_HALF_FLOAT
+
+        block = encode_block(c.curve_format, c.values)
+        offset = written.get(block)
+        if offset is None:
+            offset = pos
+            if dedup:
+                written[block] = offset
+            sizes.append(len(block))
+            blocks.append(block)
+            pos += len(block)
+        else:
+            sizes.append(0)
+            blocks.append(None)
+            saved += len(block)
+        offsets.append(offset)
+    return offsets, sizes, blocks, saved
+
+
+def plan_file(gmt: GMTFile, dedup=False) -> FileLayout:
+    layout = FileLayout()
+
+    layout.anm_offset = 0x80
+    layout.graph_offsets_offset = layout.anm_offset + \
+        (ANIMATION_LAYOUT.size * gmt.header.anm_count)
+
+    layout.graph_offset = layout.graph_offsets_offset + \
+        align(4 * gmt.header.graph_count, 0x10)
+    g_offsets, layout.g_sizes = plan_graphs(gmt)
+    layout.g_offsets = [x + layout.graph_offset for x in g_offsets]
+    layout.graph_data_size = align(sum(layout.g_sizes), 0x40)
+
+    layout.name_offset = layout.graph_offset + layout.graph_data_size
+    layout.anm_map_offset = layout.name_offset + (0x20 * gmt.header.name_count)
+    layout.bone_map_offset = layout.anm_map_offset + \
+        align(4 * gmt.header.anm_count, 0x20)
+    layout.curve_offset = layout.bone_map_offset + \
+        align(4 * gmt.header.bone_map_count, 0x20)
+
+    layout.anm_data_offset = layout.curve_offset + \
+        (CURVE_LAYOUT.size * gmt.header.curve_count)
+    anm_data_offsets, layout.anm_data_sizes, layout.anm_data_blocks, layout.anm_data_saved = plan_animation_data(
+        gmt, dedup)
+    layout.anm_data_offsets = [
+        x + layout.anm_data_offset for x in anm_data_offsets]
+    layout.anm_data_size = align(sum(layout.anm_data_sizes), 0x40)
+
+    layout.file_size = layout.anm_data_offset + layout.anm_data_size
+    layout.buffer_size = align(layout.file_size, 0x100)
+
+    return layout
+
+
+def write_anm_maps(gmt: GMTFile, file: BinaryReader):
     i = len(gmt.animations)
     for a in gmt.animations:
-        anm_maps.write_uint16(i)
-        anm_maps.write_uint16(len(a.bones))
+        file.write_uint16(i)
+        file.write_uint16(len(a.bones))
         i += len(a.bones)
-    anm_maps.align(0x20)
-    return anm_maps.buffer()
 
 
-def write_bone_maps(gmt: GMTFile) -> bytearray:
-    bone_maps = BinaryReader(bytearray())
+def write_bone_maps(gmt: GMTFile, file: BinaryReader):
     i = 0
     for b in gmt.bones:
-        bone_maps.write_uint16(i)
-        bone_maps.write_uint16(len(b.curves))
+        file.write_uint16(i)
+        file.write_uint16(len(b.curves))
         i += len(b.curves)
-    bone_maps.align(0x20)
-    return bone_maps.buffer()
 
 
-def write_names(gmt: GMTFile) -> bytearray:
-    names = BinaryReader(bytearray())
+def write_names(gmt: GMTFile, file: BinaryReader):
     for n in gmt.names:
-        names.write_uint16(n.checksum())
-        names.write_str(n.string(), 30)
-    return names.buffer()
+        file.write_uint16(n.checksum())
+        file.write_str(n.string(), 30)
 
 
-def write_graphs(gmt: GMTFile) -> Tuple[bytearray, List[int], List[int]]:
-    graphs = BinaryReader(bytearray())
-    offsets = []
-    sizes = []
+def write_graphs(gmt: GMTFile, file: BinaryReader):
     for g in gmt.graphs:
-        offsets.append(graphs.pos())
-        size = graphs.write_uint16(len(g.keyframes))
-        size += graphs.write_uint16(g.keyframes, len(g.keyframes))
-        size += graphs.write_int16(g.delimiter)
-        sizes.append(size)
-    graphs.align(0x40)
-    return graphs.buffer(), offsets, sizes
+        file.write_uint16(len(g.keyframes))
+        file.write_uint16(g.keyframes, len(g.keyframes))
+        file.write_int16(g.delimiter)
 
 
-def write_animation_data(gmt: GMTFile) -> Tuple[bytearray, List[int], List[int]]:
-    anm_data = BinaryReader(bytearray())
-    offsets = []
-    sizes = []
-    for c in gmt.curves:
-        if c.curve_format in [CurveFormat.ROT_QUAT_XYZ_FLOAT, CurveFormat.ROT_QUAT_INT_SCALED]:
-            c.curve_format = CurveFormat.ROT_QUAT_SCALED if gmt.header.version > 0x10001 else CurveFormat.ROT_QUAT_HALF_FLOAT
+def encode_values(curve_format: CurveFormat, values, format: str, count: int) -> numpy.ndarray:
+    # a curve's values as one (N, count) array, ready to be cast to the data format
+    size = sum(map(len, values))
+    if size != count * len(values):
+        raise ValueError(
+            f"{curve_format.name} curve has {size} values, expected {count * len(values)}")
+    # a flat iterator converts much faster than nested lists
+    array = numpy.fromiter(chain.from_iterable(values), float,
+                           size).reshape(len(values), count)
 
-        offsets.append(anm_data.pos())
-        if 'POS' in c.curve_format.name:
-            if 'VEC3' in c.curve_format.name:
-                sizes.append(anm_data.write_float(
-                    c.values, 3, is_iterable=True))
-            else:  # 'X', 'Y', 'Z'
-                sizes.append(anm_data.write_float(
-                    c.values, 1, is_iterable=True))
-        elif 'ROT' in c.curve_format.name:
-            if 'QUAT' in c.curve_format.name:
-                if 'SCALED' in c.curve_format.name:
-                    sizes.append(anm_data.write_int16(list(map(
-                        lambda x: [int(y * 16_384) for y in x], c.values)), count=4, is_iterable=True))
-                else:  # 'HALF_FLOAT'
-                    sizes.append(anm_data.write_half_float(
-                        c.values, 4, is_iterable=True))
-            elif 'W' in c.curve_format.name:
-                if 'W_SCALED' in c.curve_format.name:
-                    sizes.append(anm_data.write_int16(list(map(
-                        lambda x: [int(y * 16_384) for y in x], c.values)), count=2, is_iterable=True))
-                elif 'W_FLOAT' in c.curve_format.name:
-                    sizes.append(anm_data.write_float(
-                        c.values, 2, is_iterable=True))
-                else:  # 'W_HALF_FLOAT'
-                    sizes.append(anm_data.write_half_float(
-                        c.values, 2, is_iterable=True))
-        elif 'PAT1' in c.curve_format.name:
-            sizes.append(anm_data.write_int16(c.values, 2, is_iterable=True))
-        elif 'PAT2' in c.curve_format.name:
-            sizes.append(anm_data.write_int8(c.values, 1, is_iterable=True))
-        else:
-            # only falls for unknown face_c_n patterns
-            sizes.append(anm_data.write_int8(c.values, 1, is_iterable=True))
+    if format in ('h', 'b'):
+        if 'SCALED' in curve_format.name:
+            # truncated towards zero, like int()
+            array = numpy.trunc(array * 16_384)
+        # out of range values saturate instead of wrapping around
+        limits = numpy.iinfo(numpy.int16 if format == 'h' else numpy.int8)
+        array = numpy.clip(array, limits.min, limits.max)
+
+    return array
 
-    anm_data.align(0x40)
-    return anm_data.buffer(), offsets, sizes
 
+def encode_block(curve_format: CurveFormat, values) -> bytes:
+    # a curve's animation data as it is written to the file, always big endian
+    format, count = data_format(curve_format)
+    array = encode_values(curve_format, values, format, count)
+    return numpy.ascontiguousarray(array, '>' + format).tobytes()
 
-def write_graph_offsets(gmt: GMTFile, g_offsets: List[int]):
-    graph_offsets = BinaryReader(bytearray())
-    graph_offsets.write_uint32(g_offsets, len(g_offsets))
-    graph_offsets.align(0x10)
-    return graph_offsets.buffer()
 
+def write_animation_data(blocks: List[bytes], file: BinaryReader):
+    # blocks are laid out in order, shared ones were only planned once
+    for block in blocks:
+        if block is not None:
+            file.write_bytes(block)
 
-def write_curves(gmt: GMTFile, anm_data_offsets: List[int]):
-    curves = BinaryReader(bytearray())
+
+def write_graph_offsets(gmt: GMTFile, file: BinaryReader, g_offsets: List[int]):
+    file.write_uint32(g_offsets, len(g_offsets))
+
+
+def write_curves(gmt: GMTFile, file: BinaryReader, anm_data_offsets: List[int]):
     offsets = iter(anm_data_offsets)
+    graphs = graph_index(gmt.graphs)
     for c in gmt.curves:
-        curves.write_uint32(gmt.graphs.index(
-            [g for g in gmt.graphs if g.keyframes == c.graph.keyframes][0]))
-        curves.write_uint32(next(offsets))
         format = pack_curve_format(
             c.curve_format) if c.curve_format.value[1] != -1 else (c.property_fmt, c.format)
-        curves.write_uint32(format[0])
-        curves.write_uint32(format[1])
-    return curves.buffer()
+        file.write_record(CURVE_LAYOUT, {
+            'graph_index': graphs[c.graph.keyframes],
+            'anm_data_offset': next(offsets),
+            'property_fmt': format[0],
+            'format': format[1],
+        })
 
 
-def write_animations(gmt: GMTFile, anm_data_sizes, anm_data_offsets, g_sizes, g_offsets):
-    anms = BinaryReader(bytearray())
+def write_animations(gmt: GMTFile, file: BinaryReader, anm_data_sizes, anm_data_offsets, g_sizes, g_offsets):
     bone_map_start = 0
     for a in gmt.animations:
-        anms.write_uint32(0)
-        anms.write_uint32(a.frame_count)
-        anms.write_uint32(a.index)
-        anms.write_float(a.frame_rate)
-        anms.write_uint32(a.index1)
-        anms.write_uint32(a.index2)
-        anms.write_uint32(bone_map_start)
-        bone_map_start += a.bone_map_count
-        anms.write_uint32(a.bone_map_count)
-        anms.write_uint32(a.curve_count)
-        anms.write_uint32(a.index3)
-        anms.write_uint32(a.graph_count)
-
         """
         first_curve = gmt.curves.index(a.curves[0])
         data_size = 0
         for c in range(a.curve_count):
             data_size += anm_data_sizes[first_curve + c]
-        anms.write_uint32(data_size)
-        anms.write_uint32(anm_data_offsets[first_curve])
         """
         data_size = 0
         for c in range(a.curve_count):
             data_size += anm_data_sizes[c]
-        anms.write_uint32(data_size)
-        anms.write_uint32(anm_data_offsets[0])
 
         first_graph = gmt.graphs.index(a.graphs[0])
         graph_size = 0
         for g in range(a.graph_count):
             graph_size += g_sizes[first_graph + g]
-        anms.write_uint32(graph_size)
-        anms.write_uint32(g_offsets[first_graph])
-
-        anms.write_uint32(0)
-    return anms.buffer()
-
-
-def write_file(gmt: GMTFile, version: int):
-    file = BinaryReader(bytearray())
-    gmt.update()
-
-    anm_maps = write_anm_maps(gmt)
-
-    bone_maps = write_bone_maps(gmt)
-
-    names = write_names(gmt)
-
-    graphs, g_offsets, g_sizes = write_graphs(gmt)
-
-    anm_data, anm_data_offsets, anm_data_sizes = write_animation_data(gmt)
-
-    header_alloc = 0x80
-    anm_alloc = 0x40 * gmt.header.anm_count
-    graph_offsets_alloc = 4 * gmt.header.graph_count
-    graphs_off = header_alloc + anm_alloc + graph_offsets_alloc
-
-    if graphs_off % 16:
-        graphs_off += (16 - (graphs_off % 16))
-
-    g_offsets = list(map(lambda x: x + graphs_off, g_offsets))
 
-    graph_offsets = write_graph_offsets(gmt, g_offsets)
-
-    curves_off = graphs_off + len(graphs) + \
-        len(names) + len(anm_maps) + len(bone_maps)
-
-    curves_size = (0x10 * gmt.header.curve_count)
-
-    anm_data_offsets = list(
-        map(lambda x: x + curves_off + curves_size, anm_data_offsets))
-
-    curves = write_curves(gmt, anm_data_offsets)
+        file.write_record(ANIMATION_LAYOUT, {
+            'frame_count': a.frame_count,
+            'index': a.index,
+            'frame_rate': a.frame_rate,
+            'index1': a.index1,
+            'index2': a.index2,
+            'bone_map_start': bone_map_start,
+            'bone_map_count': a.bone_map_count,
+            'curve_count': a.curve_count,
+            'index3': a.index3,
+            'graph_count': a.graph_count,
+            'anm_data_size': data_size,
+            'anm_data_offset': anm_data_offsets[0],
+            'graph_data_size': graph_size,
+            'graph_data_offset': g_offsets[first_graph],
+        })
+        bone_map_start += a.bone_map_count
 
-    animations = write_animations(
-        gmt, anm_data_sizes, anm_data_offsets, g_sizes, g_offsets)
 
-    # write header
+def write_header(gmt: GMTFile, file: BinaryReader, layout: FileLayout, version: int):
     file.write_str("GSGT", length=4)
     file.write_uint8(2)
     file.write_uint8(1)
     file.write_uint16(0)
-    file.write_uint32(version)
-    # file_size
-    file.write_uint32(0)
-
-    file.write_uint16(gmt.header.file_name.checksum())
-    file.write_str(gmt.header.file_name.string(), 30)
-
-    file.write_uint32(gmt.header.anm_count)
-    file.write_uint32(header_alloc)
-
-    file.write_uint32(gmt.header.graph_count)
-    file.write_uint32(header_alloc + anm_alloc)
-
-    file.write_uint32(len(graphs))
-    file.write_uint32(graphs_off)
-
-    file.write_uint32(gmt.header.name_count)
-    file.write_uint32(graphs_off + len(graphs))
-
-    file.write_uint32(gmt.header.anm_count)
-    file.write_uint32(graphs_off + len(graphs) + len(names))
-
-    file.write_uint32(gmt.header.bone_map_count)
-    file.write_uint32(graphs_off + len(graphs) + len(names) + len(anm_maps))
-
-    file.write_uint32(gmt.header.curve_count)
-    file.write_uint32(curves_off)
-
-    file.write_uint32(len(anm_data))
-    file.write_uint32(curves_off + len(curves))
-
-    file.write_uint32(0)
-    file.write_uint32(0)
-    file.write_uint32(0)
-    file.write_uint32(gmt.header.flags)
+    file.write_record(HEADER_LAYOUT, {
+        'version': version,
+        'data_size': layout.file_size,
+        'file_name_checksum': gmt.header.file_name.checksum(),
+        'file_name': gmt.header.file_name.string(),
+        'anm_count': gmt.header.anm_count,
+        'anm_offset': layout.anm_offset,
+        'graph_count': gmt.header.graph_count,
+        'graph_offset': layout.graph_offsets_offset,
+        'graph_data_size': layout.graph_data_size,
+        'graph_data_offset': layout.graph_offset,
+        'name_count': gmt.header.name_count,
+        'name_offset': layout.name_offset,
+        'anm_map_count': gmt.header.anm_count,
+        'anm_map_offset': layout.anm_map_offset,
+        'bone_map_count': gmt.header.bone_map_count,
+        'bone_map_offset': layout.bone_map_offset,
+        'curve_count': gmt.header.curve_count,
+        'curve_offset': layout.curve_offset,
+        'anm_data_size': layout.anm_data_size,
+        'anm_data_offset': layout.anm_data_offset,
+        'flags': gmt.header.flags,
+    })
+
+
+def write_sections(gmt: GMTFile, file: BinaryReader, layout: FileLayout, version: int):
+    # every section is packed in place at its planned offset
+    # alignment padding is already zero in the preallocated buffer
+    file.seek(0)
+    write_header(gmt, file, layout, version)
+
+    file.seek(layout.anm_offset)
+    write_animations(gmt, file, layout.anm_data_sizes,
+                     layout.anm_data_offsets, layout.g_sizes, layout.g_offsets)
+
+    file.seek(layout.graph_offsets_offset)
+    write_graph_offsets(gmt, file, layout.g_offsets)
+
+    file.seek(layout.graph_offset)
+    write_graphs(gmt, file)
+
+    file.seek(layout.name_offset)
+    write_names(gmt, file)
+
+    file.seek(layout.anm_map_offset)
+    write_anm_maps(gmt, file)
+
+    file.seek(layout.bone_map_offset)
+    write_bone_maps(gmt, file)
+
+    file.seek(layout.curve_offset)
+    write_curves(gmt, file, layout.anm_data_offsets)
+
+    file.seek(layout.anm_data_offset)
+    write_animation_data(layout.anm_data_blocks, file)
+
+
+def write_file(gmt: GMTFile, version: int, path: str = None, dedup=False, stats=None):
+    # returns the file as a bytearray, or writes it straight to path
+    # and returns the number of bytes written
+    # with dedup, identical curve data is written once, and the bytes that saved
+    # are added to stats, if given
+    gmt.update()
 
-    file.extend(animations)
-    file.extend(graph_offsets)
-    file.extend(graphs)
-    file.extend(names)
-    file.extend(anm_maps)
-    file.extend(bone_maps)
-    file.extend(curves)
-    file.extend(anm_data)
+    layout = plan_file(gmt, dedup)
+    if dedup and stats is not None:
+        stats['dedup saved'] = stats.get(
+            'dedup saved', 0) + layout.anm_data_saved
 
-    file.seek(0, from_end=True)
-    file_size = file.pos()
-    file.seek(0xC)
-    file.write_uint32(file_size)
+    if path:
+        with map_output(path, layout.buffer_size) as buffer:
+            write_sections(gmt, BinaryReader(buffer), layout, version)
+        return layout.buffer_size
 
-    file.seek(0, from_end=True)
-    file.align(0x100)
+    file = BinaryReader(bytearray(layout.buffer_size))
+    write_sections(gmt, file, layout, version)
 
     return file.buffer()